@@ -0,0 +1,1076 @@
+#!/usr/bin/env python3
+"""
+ローカルのスタブサーバーを相手に、処理速度を計測する
+
+--record を与えると結果を JSON Lines で追記し、前回の記録からの変化も表示する。
+それ以外の引数は downloader.py と同じものとして扱う (e.g. --parser bs4)
+"""
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from re import findall
+from time import perf_counter, process_time, sleep
+from typing import Any, Deque, Dict, Iterator, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import downloader
+from database_helper import DBCreation
+from modules import corpus
+from modules.argments import args, parse_args
+from modules.classes import (
+    ConcurrentThreadsDownloader,
+    Converter,
+    ConverterDB,
+    ThreadsDownloader,
+    ThreadsIndexer,
+    INSERT_POSTS,
+)
+from modules.collector import SOURCES, IndexCollector
+from modules.connection import GroupCommit, connect
+from modules.corpus import thread_page
+from modules.errors import BadContentError, DownloadError
+from modules.kakolog import KakologThreadsIndexer, KakologThreadsRequest
+from modules.parsers import PARSERS
+from modules.ratecontrol import AdaptiveRateController
+from modules.timestamps import index_date, post_date
+from search import search
+
+bench_parser = ArgumentParser(description="処理速度を計測する")
+bench_parser.add_argument(
+    "--record", default=None, metavar="path", help="結果を追記する JSON Lines のファイル")
+bench_parser.add_argument(
+    "--only", nargs="*", default=None, metavar="name", help="実行するベンチマークの名前")
+# bench_parser が読まなかった引数 (downloader.py の引数として扱う)
+downloader_argv: List[str] = []
+
+STUB_PAGE = (
+    '<html><head><meta http-equiv="Content-Type" content="text/html; charset=Shift_JIS">'
+    "</head><body>" + "<article>stub</article>" * 200 + "</body></html>"
+).encode("cp932")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.05
+    page = STUB_PAGE
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        sleep(self.latency)
+        self.send_body(self.page, "text/html; charset=Shift_JIS")
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        return
+
+
+@contextmanager
+def stub_servers(count: int, handler=StubHandler) -> Iterator[List[str]]:
+    """
+    スタブサーバーを count 個立ち上げ、それぞれの "host:port" を返す
+    """
+    servers = [ThreadingHTTPServer(("127.0.0.1", 0), handler) for _ in range(count)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield [f"127.0.0.1:{s.server_address[1]}" for s in servers]
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+HTTPS_THREAD_URL = ThreadsDownloader.thread_url
+
+
+def local_thread_url(server: str, bbs: str, bbskey: int, since: int = 0) -> str:
+    """
+    スタブサーバーは TLS を話さないので http にする
+    """
+    url = HTTPS_THREAD_URL(server, bbs, bbskey, since)
+    return url.replace("https:", "http:", 1)
+
+
+class LocalThreadsDownloader(ThreadsDownloader):
+    thread_url = staticmethod(local_thread_url)
+
+
+class LocalConcurrentThreadsDownloader(ConcurrentThreadsDownloader):
+    thread_url = staticmethod(local_thread_url)
+
+
+def bench_download(threads: int = 80, hosts: int = 4, interval: float = 0.05,
+                   jobs: int = 8) -> Tuple[float, float]:
+    """
+    downloader.py の直列ループと、並行ダウンロードのスループット (threads/s) を比べる
+    """
+    with stub_servers(hosts) as servers:
+        targets = [
+            (servers[i % hosts], "liveuranus", 1600000000 + i, f"thread {i}")
+            for i in range(threads)
+        ]
+
+        start = perf_counter()
+        for _ in LocalThreadsDownloader().generate_response(targets):
+            sleep(interval)
+        serial = threads / (perf_counter() - start)
+
+        start = perf_counter()
+        for _ in LocalConcurrentThreadsDownloader(jobs, interval).generate_response(targets):
+            pass
+        concurrent = threads / (perf_counter() - start)
+
+    return serial, concurrent
+
+
+class ThrottlingHandler(StubHandler):
+    """
+    直近 1 秒に limit 件を超えるリクエストには、429 と Retry-After を返す
+    """
+    latency = 0.02
+    limit = 10
+    retry_after = 1
+    # bench_throttling() がサーバーごとに与える
+    lock: threading.Lock
+    accepted: Deque[float]
+    stats: Dict[str, int]
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        with self.lock:
+            now = perf_counter()
+            while self.accepted and self.accepted[0] < now - 1:
+                self.accepted.popleft()
+            allowed = len(self.accepted) < self.limit
+            if allowed:
+                self.accepted.append(now)
+            else:
+                self.stats["throttled"] += 1
+        if not allowed:
+            body = b"Too Many Requests"
+            self.send_response(429)
+            self.send_header("Retry-After", str(self.retry_after))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super().do_GET()
+
+
+def bench_throttling(threads: int = 40, limit: int = 10,
+                     jobs: int = 8) -> Dict[str, float]:
+    """
+    直近 1 秒に limit 件までしか受け付けないスタブサーバーから threads 個のスレッドを取得し、
+    かかった時間 (秒)、429 の数、諦めたスレッドの数を比べる
+
+    - fixed_fast: 間隔 0.01 秒で jobs 本同時に (429 が返るたびに Retry-After だけ待つ)
+    - fixed_slow: 429 が返らないよう、間隔を 1 / (limit / 2) 秒に固定
+    - adaptive: fixed_slow の間隔から始め、0.01 秒から 5 秒の間で変える
+    """
+    slow = 2 / limit
+    rates = {
+        "fixed_fast": lambda: AdaptiveRateController(0.01, concurrency=jobs),
+        "fixed_slow": lambda: AdaptiveRateController(slow, concurrency=jobs),
+        "adaptive": lambda: AdaptiveRateController(slow, 0.01, 5, max_concurrency=jobs),
+    }
+    results = {}
+    for name, rate in rates.items():
+        handler = type("Handler", (ThrottlingHandler,), {
+            "limit": limit, "lock": threading.Lock(), "accepted": deque(),
+            "stats": {"throttled": 0}})
+        with stub_servers(1, handler) as servers:
+            targets = [(servers[0], "liveuranus", 1600000000 + i, f"thread {i}")
+                       for i in range(threads)]
+            downloader_ = LocalConcurrentThreadsDownloader(jobs, slow, rate=rate())
+            start = perf_counter()
+            failed = sum(isinstance(text, Exception)
+                         for _, _, text, _ in downloader_.generate_response(targets))
+            results[f"throttling_{name}_sec"] = perf_counter() - start
+            results[f"throttling_{name}_429"] = handler.stats["throttled"]
+            results[f"throttling_{name}_failed"] = failed
+            # 429 が返っても、Retry-After を待って取り直せば諦めずに済む
+            assert failed == 0, (name, failed)
+    assert results["throttling_adaptive_429"] < results["throttling_fixed_fast_429"], results
+    results.update(check_rate_control())
+    return results
+
+
+class FaultyHandler(StubHandler):
+    """
+    板の名前によって、次の応答を返す (それ以外は StubHandler と同じ)
+
+    - retry_after: 最初のリクエストにだけ 429 と Retry-After: 1
+    - gone: dat 落ちの本文 ("Gone.")
+    - truncated: Content-Length の半分を送ったところで接続を切る
+    - empty: 200 で本文が空
+
+    リクエストを受けた時刻を、パスごとに requests に記録する
+    """
+    latency = 0.01
+    # check_rate_control() がサーバーごとに与える
+    lock: threading.Lock
+    requests: Dict[str, List[float]]
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        with self.lock:
+            times = self.requests.setdefault(self.path, [])
+            times.append(perf_counter())
+            first = len(times) == 1
+        bbs = self.path.split("/")[3]
+        if bbs == "retry_after" and first:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif bbs == "empty":
+            self.send_body(b"", "text/html; charset=Shift_JIS")
+        elif bbs == "gone":
+            self.send_body(b"Gone.\n", "text/html; charset=Shift_JIS")
+        elif bbs == "truncated":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=Shift_JIS")
+            self.send_header("Content-Length", str(len(self.page)))
+            self.end_headers()
+            self.wfile.write(self.page[:len(self.page) // 2])
+            self.close_connection = True
+        else:
+            super().do_GET()
+
+
+def check_rate_control() -> Dict[str, float]:
+    """
+    FaultyHandler を相手に、ThreadsDownloader と AdaptiveRateController の振る舞いを確かめ、
+    それぞれにかかった時間 (秒) を返す
+
+    - Retry-After の秒数だけ待ってから取り直し、そのあと間隔は min_interval まで戻る
+    - dat 落ちは再試行せず、ホストの間隔も同時に送る数も変えない
+    - 本文が途中で切れたスレッドは再試行したあと DownloadError になり、他のスレッドは取得できる
+    - 本文が空のスレッドは DownloadError になり、後ろのスレッドの取得は続く
+    """
+    handler = type("Handler", (FaultyHandler,), {"lock": threading.Lock(), "requests": {}})
+    results = {}
+    with stub_servers(1, handler) as servers:
+        host = servers[0]
+
+        def targets(bbs: str, count: int = 1):
+            return [(host, bbs, 1600000000 + i, f"{bbs} {i}") for i in range(count)]
+
+        def times(bbs: str, bbskey: int = 1600000000) -> List[float]:
+            return handler.requests[f"/test/read.cgi/{bbs}/{bbskey}/"]
+
+        rate = AdaptiveRateController(0.05, 0.01, 5)
+        start = perf_counter()
+        responses = list(LocalThreadsDownloader(rate=rate).generate_response(
+            targets("retry_after") + targets("liveuranus", 40)))
+        results["throttling_retry_after_sec"] = perf_counter() - start
+        assert not any(isinstance(text, Exception) for _, _, text, _ in responses)
+        first, second = times("retry_after")
+        assert second - first >= 0.95, second - first
+        assert rate.summary()[host]["interval"] == rate.min_interval, rate.summary()
+
+        rate = AdaptiveRateController(1, 1, 60)
+        start = perf_counter()
+        (_, _, error, _), = LocalThreadsDownloader(rate=rate).generate_response(targets("gone"))
+        results["throttling_gone_sec"] = perf_counter() - start
+        assert isinstance(error, DownloadError), error
+        assert len(times("gone")) == 1, times("gone")
+        assert rate.summary()[host] == {"interval": 1, "concurrency": 1}, rate.summary()
+        assert results["throttling_gone_sec"] < 1, results["throttling_gone_sec"]
+
+        rate = AdaptiveRateController(0, backoff=0.01, max_concurrency=4)
+        start = perf_counter()
+        responses = list(LocalConcurrentThreadsDownloader(4, 0, rate=rate).generate_response(
+            targets("truncated") + targets("liveuranus", 8)))
+        results["throttling_truncated_sec"] = perf_counter() - start
+        assert isinstance(responses[0][2], DownloadError), responses[0]
+        assert not any(isinstance(text, Exception) for _, _, text, _ in responses[1:])
+        assert len(times("truncated")) == args.max_retry, times("truncated")
+
+        responses = list(LocalThreadsDownloader(rate=AdaptiveRateController()).generate_response(
+            targets("empty") + targets("liveuranus", 3)))
+        assert isinstance(responses[0][2], DownloadError), responses[0]
+        assert [bbskey for bbskey, _, text, _ in responses[1:] if isinstance(text, str)] \
+            == [1600000000, 1600000001, 1600000002], responses
+    return results
+
+
+def timeit(func) -> float:
+    start = perf_counter()
+    func()
+    return perf_counter() - start
+
+
+def bench_parse(posts=(10, 100, 1000), rounds: int = 3) -> Dict[str, Dict[int, float]]:
+    """
+    パーサーごとに、1 スレッドの変換にかかる時間 (秒) を測る
+
+    どのパーサーも BeautifulSoup と同じ結果を返すことを先に確かめる
+    """
+    pages = {n: thread_page(n) for n in posts}
+    for n, page in pages.items():
+        expected = Converter(n, page, engine="bs4").convert()
+        for engine in PARSERS:
+            assert Converter(n, page, engine=engine).convert() == expected, (engine, n)
+
+    return {
+        engine: {
+            n: min(timeit(lambda: Converter(n, page, engine=engine).convert())
+                   for _ in range(rounds))
+            for n, page in pages.items()
+        }
+        for engine in PARSERS
+    }
+
+
+def legacy_post_date(date: str) -> str:
+    """
+    modules.timestamps を使う前の Converter の日時の変換
+    """
+    if date == "NG":
+        return ""
+    extracted = findall(r"\d+", date)
+    assert len(extracted) == 7
+    return (
+        datetime.strptime("%s/%s/%s %s:%s:%s.%s" % tuple(extracted), "%Y/%m/%d %H:%M:%S.%f")
+        .astimezone(timezone(timedelta(hours=9)))
+        .isoformat()
+    )
+
+
+def legacy_index_date(date: str) -> str:
+    return datetime.strptime(date, "%Y年%m月%d日 %H:%M") \
+        .astimezone(timezone(timedelta(hours=9))) \
+        .isoformat()
+
+
+def bench_timestamps(count: int = 100000) -> Dict[str, Tuple[float, float]]:
+    """
+    count 件の日時の変換にかかる時間 (秒) を、これまでの実装と比べる
+
+    全て同じ結果になることを先に確かめる
+    """
+    posts = [
+        "NG" if i % 97 == 0 else
+        f"2023/{i % 12 + 1:02d}/{i % 28 + 1:02d}(金) "
+        f"{i % 24:02d}:{i % 60:02d}:{i * 7 % 60:02d}.{i % 1000:0{i % 3 + 1}d}"
+        for i in range(count)
+    ]
+    indexes = [
+        f"2023年{i % 12 + 1:02d}月{i % 28 + 1:02d}日 {i % 24:02d}:{i % 60:02d}" for i in range(count)
+    ]
+    cases = {"post": (posts, legacy_post_date, post_date),
+             "index": (indexes, legacy_index_date, index_date)}
+
+    timings = {}
+    for key, (dates, legacy, current) in cases.items():
+        assert [legacy(d) for d in dates] == [current(d) for d in dates], key
+        timings[key] = (timeit(lambda: [legacy(d) for d in dates]),
+                        timeit(lambda: [current(d) for d in dates]))
+    return timings
+
+
+def bench_memory(threads: int = 30, posts: int = 1000,
+                 engine: str = "lxml") -> Tuple[float, float]:
+    """
+    threads 個のスレッドを変換して溜めておくときのメモリのピーク (MiB) を、
+    レスごとの辞書 (これまでの convert_markup) と PostRecord で比べる
+    """
+    page = thread_page(posts)
+    peaks = []
+    for convert in (lambda n: list(Converter(n, page, engine=engine).convert().values()),
+                    lambda n: Converter(n, page, engine=engine).records()):
+        tracemalloc.start()
+        batch = [convert(n) for n in range(threads)]
+        peaks.append(tracemalloc.get_traced_memory()[1] / 2**20)
+        tracemalloc.stop()
+        del batch
+    return peaks[0], peaks[1]
+
+
+# 移行前の difference ビュー (messages を全て読む)
+LEGACY_DIFFERENCE = """
+    SELECT server, bbs, thread_indexes.bbskey, title FROM (
+        SELECT bbskey FROM thread_indexes
+            EXCEPT SELECT DISTINCT bbskey FROM messages
+        UNION
+        SELECT bbskey FROM thread_indexes
+            WHERE is_live = 1 AND resnum < 1002 AND datetime('now','-14 days') < updated
+        ORDER BY 1
+    ) AS difference_bbskey
+    INNER JOIN thread_indexes ON thread_indexes.bbskey = difference_bbskey.bbskey
+"""
+
+
+def bench_difference(threads: int = 2000, posts: int = 1000,
+                     rounds: int = 3) -> Tuple[float, float, str]:
+    """
+    threads * posts 行の messages を持つデータベースで、差分のビューにかかる時間 (秒) を比べる
+
+    一割のスレッドは未変換、2% は実況中にしておく
+    """
+    with temporary_database() as path:
+        db = DBCreation(path)
+        archived = threads - threads // 10
+        db.cursor.executemany(
+            "INSERT INTO thread_indexes VALUES (?, ?, ?, ?, ?, ?, datetime('now'), ?, ?)",
+            (("eagle.5ch.net", "liveuranus", key, f"thread {key}", posts, "2023-06-19",
+              int(key % 50 == 0), posts if key < archived else None)
+             for key in range(threads)))
+        db.cursor.executemany(
+            "INSERT INTO messages VALUES (?, ?, '名無しさん', '2023-06-19', 'aBcD', '本文')",
+            ((key, number) for key in range(archived) for number in range(1, posts + 1)))
+        db.commit()
+        db.cursor.execute("ANALYZE")
+
+        legacy = min(timeit(lambda: db.cursor.execute(LEGACY_DIFFERENCE).fetchall())
+                     for _ in range(rounds))
+        current = min(timeit(lambda: db.cursor.execute("SELECT * FROM difference").fetchall())
+                      for _ in range(rounds))
+        plan = "\n".join(
+            r[3] for r in db.cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM difference"))
+        assert "messages" not in plan
+        db.close()
+
+    return legacy, current, plan
+
+
+@contextmanager
+def temporary_database() -> Iterator[str]:
+    """
+    テーブルとビューを作った一時的なデータベースのパスを返す
+    """
+    fd, path = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(fd)
+    try:
+        DBCreation(path).create_tables().create_views().commit().close()
+        yield path
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def synthetic_indexes(count: int) -> Iterator[Dict[str, int | str]]:
+    for key in range(count):
+        yield {
+            "server": "eagle.5ch.net", "bbs": "liveuranus", "bbskey": 1600000000 + key,
+            "title": f"なんJNVA部★{key}", "resnum": 1002, "created": "2023-06-19T00:00:00+09:00",
+            "updated": "2023-06-20T00:00:00+09:00", "is_live": 0,
+        }
+
+
+def legacy_insert_indexes(db: ConverterDB, indexes) -> None:
+    """
+    executemany を使う前の insert_indexes (1 行ずつ execute する)
+    """
+    for index in indexes:
+        db.cursor.execute(
+            """
+            INSERT INTO thread_indexes (
+                server, bbs, bbskey, title, resnum, created, updated, is_live)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (bbs, bbskey)
+            DO UPDATE SET resnum = ?, updated = ?, is_live = ?
+            """,
+            tuple(index.get(k) for k in ConverterDB.INDEX_FIELDS)
+            + (index.get("resnum"), index.get("updated"), index.get("is_live")),
+        )
+    db.commit()
+
+
+def bench_insert_indexes(count: int = 100000) -> Tuple[float, float]:
+    """
+    count 件のインデックスを、空のテーブルに入れてから同じものでもう一度更新する時間 (秒)
+    """
+    timings = []
+    for insert in (legacy_insert_indexes, ConverterDB.insert_indexes):
+        with temporary_database() as path:
+            db = ConverterDB(path)
+            timings.append(timeit(lambda: [insert(db, synthetic_indexes(count)) for _ in range(2)]))
+            db.close()
+    return timings[0], timings[1]
+
+
+def legacy_pending_raw(db: ConverterDB) -> Iterator[Tuple[int, str, bytes | str]]:
+    """
+    iter_pending_raw() の前の convert() の読み方 (bbskey を全て読んでから、一件ずつ引く)
+    """
+    keys = db.connect.execute(
+        "SELECT bbskey FROM thread_raw WHERE pending = 1 ORDER BY bbskey").fetchall()
+    for k in keys:
+        yield db.connect.execute(
+            "SELECT bbskey, title, raw_text "
+            "FROM thread_raw INNER JOIN thread_indexes USING (bbskey) "
+            "WHERE bbskey = ?", k).fetchone()
+
+
+def legacy_all_available(db: ConverterDB) -> List[Tuple[str, str, int, str]]:
+    """
+    iter_all_available() の前の読み方 (すべての行を fetchall() で一度に読む)
+    """
+    return db.connect.execute("SELECT server, bbs, bbskey, title FROM thread_indexes").fetchall()
+
+
+def bench_chunked(sizes: Tuple[int, ...] = (10000, 40000)) -> Dict[str, float]:
+    """
+    fetchall() と chunk ごとの読み出し (keyset pagination) を比べる
+
+    - 全スレッドを作業表に積むときのメモリのピーク (MiB) を、スレッドの数ごとに
+    - 変換待ちの生の HTML を全て読む時間 (秒)
+    """
+    page = thread_page(5)
+    results = {}
+    for size in sizes:
+        with temporary_database() as path:
+            db = ConverterDB(path)
+            db.insert_indexes(synthetic_indexes(size))
+            for key in range(size):
+                db.update_raw_data(1600000000 + key, page)
+            db.commit()
+
+            for name, targets in (("fetchall", lambda: legacy_all_available(db)),
+                                  ("chunked", db.iter_all_available)):
+                db.connect.execute("DELETE FROM crawl_jobs")
+                tracemalloc.start()
+                db.enqueue_jobs(targets()).commit()
+                results[f"enqueue_{size}_{name}_peak_mib"] = \
+                    tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+
+            for name, rows in (("per_key", lambda: legacy_pending_raw(db)),
+                               ("chunked", db.iter_pending_raw)):
+                start = perf_counter()
+                count = sum(1 for _ in rows())
+                results[f"pending_raw_{size}_{name}_sec"] = perf_counter() - start
+                assert count == size, count
+            db.close()
+    return results
+
+
+WORDS = (
+    "プロンプト", "ネガティブ", "LoRA", "学習", "モデル", "マージ", "VAE", "サンプラー",
+    "解像度", "アップスケール", "ControlNet", "背景", "構図", "手", "指", "顔", "服",
+    "ええな", "ワイも", "これ", "すごい", "わからん", "試した", "出ない", "できた", "草",
+)
+
+
+def bench_search(posts: int = 200000, rounds: int = 5) -> Tuple[float, float, float, float]:
+    """
+    posts 件のレスから語句を探す時間 (秒) を、LIKE と全文検索の索引で比べる
+    """
+    rnd = random.Random(0)
+    query = "アップスケール"
+    with temporary_database() as path:
+        db = DBCreation(path)
+        db.cursor.executemany(
+            "INSERT INTO messages VALUES (?, ?, '名無しさん', '2023-06-19', 'aBcD', ?)",
+            ((key // 1000, key % 1000 + 1, "".join(rnd.choices(WORDS, k=12)))
+             for key in range(posts)))
+        db.commit().close()
+
+        with closing(sqlite3.connect(path)) as conn:
+            like = min(timeit(lambda: conn.execute(
+                "SELECT bbskey, number FROM messages WHERE message LIKE ? LIMIT 20",
+                (f"%{query}%",)).fetchall()) for _ in range(rounds))
+            fts = min(timeit(lambda: search(conn, query)) for _ in range(rounds))
+            # LIKE は先に見つかった 20 件で終わるので、全件数える場合も測る
+            like_all = min(timeit(lambda: conn.execute(
+                "SELECT count(*) FROM messages WHERE message LIKE ?",
+                (f"%{query}{query}{query}%",)).fetchall()) for _ in range(rounds))
+            fts_all = min(timeit(lambda: conn.execute(
+                "SELECT count(*) FROM messages_fts WHERE messages_fts MATCH ?",
+                (f'"{query}{query}{query}"',)).fetchall()) for _ in range(rounds))
+
+    return like, fts, like_all, fts_all
+
+
+class ThreadPageHandler(StubHandler):
+    latency = 0.2
+    page = thread_page(500, "Shift_JIS").encode("cp932")
+
+
+def bench_pipeline(threads: int = 30, engine: str = "bs4") -> Tuple[float, float]:
+    """
+    ダウンロードしてから変換する場合と、ダウンロードしながら変換する場合の全体の時間 (秒)
+
+    ダウンロードは同じ設定 (ワーカー 1 つ、間隔なし) にして、重なりの分だけを比べる
+    """
+    timings = []
+    with stub_servers(1, ThreadPageHandler) as servers:
+        targets = [(servers[0], "liveuranus", 1600000000 + i, f"thread {i}")
+                   for i in range(threads)]
+        for pipeline in (False, True):
+            with temporary_database() as path:
+                db = ConverterDB(path)
+                start = perf_counter()
+                for bbskey, _, text, _ in LocalConcurrentThreadsDownloader(
+                        1, 0).generate_response(targets):
+                    db.update_raw_data(bbskey, text)
+                    if pipeline:
+                        db.insert_posts(
+                            Converter(bbskey, text, engine=engine).records()
+                        ).mark_converted(bbskey)
+                    db.commit()
+                if not pipeline:
+                    # convert() と同じく、保存した HTML を読み直して変換する
+                    for bbskey, raw in db.connect.execute(
+                            "SELECT bbskey, raw_text FROM thread_raw WHERE pending = 1").fetchall():
+                        db.insert_posts(
+                            Converter(bbskey, db.codec.decode(raw), engine=engine).records()
+                        ).mark_converted(bbskey).commit()
+                timings.append(perf_counter() - start)
+                db.close()
+
+    return timings[0], timings[1]
+
+
+def legacy_fetch_thread(session, url: str) -> str:
+    """
+    ストリーミングにする前の fetch_thread() と _as_response() の読み方
+    """
+    response = session.get(url, timeout=10)
+    response.raise_for_status()
+    if "Gone.\n" in response.text:
+        raise BadContentError("found 'Gone.' in the response")
+    return response.text.replace("charset=Shift_JIS", 'charset="UTF-8"')
+
+
+def bench_streaming(posts: int = 5000, rounds: int = 5) -> Dict[str, float]:
+    """
+    posts 件のレスがあるスレッドのページ (CP932) を取得して文字列にするときの
+    メモリのピーク (MiB) と CPU 時間 (秒、スタブサーバーの分も含む) を、
+    response.text を使うこれまでの読み方とストリーミングで比べる
+
+    dat 落ちのページ (先頭に "Gone." があり、その後も続く) で諦めるまでの時間 (秒) も比べる
+    """
+    big = thread_page(posts, "Shift_JIS").encode("cp932")
+    pages = {"/big": big, "/gone": b"Gone.\n" + big}
+
+    class Handler(StubHandler):
+        latency = 0
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # "Gone." を見つけたクライアントは、残りを読まずに切る
+                self.close_connection = True
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self.send_body(pages[self.path], "text/html; charset=Shift_JIS")
+
+    results: Dict[str, float] = {}
+    with stub_servers(1, Handler) as servers:
+        downloader_ = LocalThreadsDownloader()
+        session = downloader_.session
+        big_url, gone_url = f"http://{servers[0]}/big", f"http://{servers[0]}/gone"
+        fetches = {
+            "legacy": lambda url: legacy_fetch_thread(session, url),
+            "streaming": lambda url: downloader_.fetch_thread(url, conditional=False),
+        }
+        assert fetches["legacy"](big_url) == fetches["streaming"](big_url)
+        for name, fetch in fetches.items():
+            tracemalloc.start()
+            fetch(big_url)
+            results[f"fetch_{posts}_posts_{name}_peak_mib"] = \
+                tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+            timings = []
+            for _ in range(rounds):
+                start = process_time()
+                fetch(big_url)
+                timings.append(process_time() - start)
+            results[f"fetch_{posts}_posts_{name}_cpu_sec"] = min(timings)
+
+            timings = []
+            for _ in range(rounds):
+                start = perf_counter()
+                try:
+                    fetch(gone_url)
+                except BadContentError:
+                    pass
+                timings.append(perf_counter() - start)
+            results[f"fetch_gone_{name}_sec"] = min(timings)
+    return results
+
+
+class CorpusHandler(StubHandler):
+    """
+    modules.corpus のデータを、read.cgi、find.5ch.net、kakolog.jp の API の代わりに返す
+    """
+    latency = 0.02
+    posts = 500
+    entries: List[Dict[str, int | str]] = []
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def thread(bbskey: int, posts: int) -> bytes:
+        return thread_page(posts, "Shift_JIS", bbskey).encode("cp932")
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path.startswith("/test/read.cgi/"):
+            bbskey = int(url.path.split("/")[4])
+            self.send_body(self.thread(bbskey, self.posts), "text/html; charset=Shift_JIS")
+        elif url.path == "/search":
+            self.send_body(corpus.search_page(self.entries).encode("utf-8"),
+                           "text/html; charset=UTF-8")
+        elif url.path == "/kakolog":
+            page = int(parse_qs(url.query)["p"][0])
+            self.send_body(corpus.kakolog_page(self.entries, page).encode("utf-8"),
+                           "application/json; charset=UTF-8")
+        else:
+            self.send_body(b"Not Found", "text/plain", 404)
+
+
+@contextmanager
+def corpus_server(threads: int, posts: int, latency: float = 0.02) -> Iterator[str]:
+    """
+    threads 個のスレッド (それぞれ posts 件のレス) を返すスタブサーバーの "host:port" を返す
+    """
+    handler = type("Handler", (CorpusHandler,), {"latency": latency, "posts": posts})
+    with stub_servers(1, handler) as servers:
+        handler.entries = corpus.threads(servers[0], threads)
+        yield servers[0]
+
+
+@contextmanager
+def local_run(path: str, server: str | None = None, **overrides: Any) -> Iterator[None]:
+    """
+    downloader.py を、データベースを path に、取得先をスタブサーバーに向けて動かせるようにする
+
+    overrides は downloader.py の引数 (modules.argments.args) を上書きする
+    """
+    saved_args = dict(vars(args))
+    saved_endpoints = (ThreadsIndexer.ENDPOINT, KakologThreadsRequest.ENDPOINT)
+    saved_path = os.environ.get("JNVADB_PATH")
+    os.environ["JNVADB_PATH"] = path
+    if server is not None:
+        ThreadsIndexer.ENDPOINT = f"http://{server}/search"
+        KakologThreadsRequest.ENDPOINT = f"http://{server}/kakolog"
+        ThreadsDownloader.thread_url = staticmethod(local_thread_url)
+    vars(args).update(overrides)
+    try:
+        yield
+    finally:
+        vars(args).update(saved_args)
+        ThreadsIndexer.ENDPOINT, KakologThreadsRequest.ENDPOINT = saved_endpoints
+        ThreadsDownloader.thread_url = staticmethod(HTTPS_THREAD_URL)
+        if saved_path is None:
+            os.environ.pop("JNVADB_PATH", None)
+        else:
+            os.environ["JNVADB_PATH"] = saved_path
+
+
+def bench_extract(threads: int = 500, rounds: int = 3) -> Tuple[float, float]:
+    """
+    threads 件の目次を、検索結果のページと過去ログの API の JSON から取り出す時間 (秒)
+    """
+    entries = corpus.threads("eagle.5ch.net", threads)
+    page = corpus.search_page(entries)
+    extracted = ThreadsIndexer("なんJNVA部").extract(page)
+    assert extracted is not None and len(extracted) == threads
+    pages = [json.loads(corpus.kakolog_page(entries, p, 50))["list"]
+             for p in range(threads // 50)]
+
+    indexer = KakologThreadsIndexer("なんJNVA部")
+    return (
+        min(timeit(lambda: ThreadsIndexer("なんJNVA部").extract(page)) for _ in range(rounds)),
+        min(timeit(lambda: [indexer.extract_status([dict(e) for e in chunk]) for chunk in pages])
+            for _ in range(rounds)),
+    )
+
+
+def bench_index(queries: int = 3, threads: int = 300, latency: float = 0.05,
+                interval: float = 0.1) -> Tuple[float, float, int, int]:
+    """
+    queries 個のクエリの目次を find.5ch.net と過去ログの両方から取得して書き込む時間 (秒) と
+    書き込んだ行数を、クエリと取得元ごとに順に取得する場合と IndexCollector で比べる
+
+    スタブサーバーはどのクエリにも同じスレッドを返すので、結果はすべて重複する
+    """
+    names = [f"なんJNVA部 {i}" for i in range(queries)]
+    timings, upserts = [], []
+    with corpus_server(threads, 1, latency) as server:
+        for collect in (False, True):
+            with temporary_database() as path, local_run(path, server):
+                db = ConverterDB(path)
+                start = perf_counter()
+                if collect:
+                    collector = IndexCollector(names, SOURCES, interval=interval)
+                    for batch in collector.iter_batches():
+                        if batch.next_page is not None:
+                            db.save_cursor(batch.source, batch.query, batch.next_page)
+                        db.insert_indexes(batch.threads).commit()
+                    upserts.append(collector.written)
+                else:
+                    rows = 0
+                    for query in names:
+                        index = ThreadsIndexer(query).get_index()
+                        assert index is not None
+                        db.insert_indexes(index).commit()
+                        rows += len(index)
+                        for page, chunk in KakologThreadsIndexer(query).iter_pages(0, interval):
+                            db.save_cursor("kakolog", query, page + 1).insert_indexes(chunk)
+                            rows += len(chunk)
+                        db.clear_cursor("kakolog", query).commit()
+                    upserts.append(rows)
+                timings.append(perf_counter() - start)
+                count, = db.cursor.execute("SELECT count(*) FROM thread_indexes").fetchone()
+                assert count == threads, count
+                db.close()
+
+    return timings[0], timings[1], upserts[0], upserts[1]
+
+
+def bench_convert(threads: int = 50, posts: int = 1000) -> Tuple[float, float]:
+    """
+    変換待ちの threads 個のスレッドを downloader.convert() で変換する速さ (threads/s, posts/s)
+    """
+    with temporary_database() as path:
+        db = ConverterDB(path)
+        entries = corpus.threads("eagle.5ch.net", threads)
+        db.insert_indexes(entries)
+        for e in entries:
+            db.update_raw_data(e["bbskey"], thread_page(posts, bbskey=int(e["bbskey"])))
+        db.commit().close()
+
+        with local_run(path):
+            converted, elapsed = downloader.convert(
+                workers=args.workers, commit_every=args.commit_every)
+        assert converted == threads
+
+    return threads / elapsed, threads * posts / elapsed
+
+
+def bench_full_run(threads: int = 30, posts: int = 500, latency: float = 0.02,
+                   kakolog: bool = False) -> float:
+    """
+    目次の取得から変換まで、downloader.py 全体をスタブサーバーに対して動かす時間 (秒)
+    """
+    argv = [*downloader_argv, "--sleep", "0", *(["--kakolog"] if kakolog else [])]
+    with corpus_server(threads, posts, latency) as server, temporary_database() as path:
+        with local_run(path, server):
+            start = perf_counter()
+            downloader.main(argv)
+            elapsed = perf_counter() - start
+
+        with closing(sqlite3.connect(path)) as conn:
+            count, = conn.execute("SELECT count(*) FROM messages").fetchone()
+        assert count == threads * posts, count
+
+    return elapsed
+
+
+# 起動の速さのために、downloader を import しただけでは読み込まないモジュール
+LAZY_MODULES = ("requests", "bs4", "lxml", "dotenv", "zstandard", "modules.classes")
+
+
+def bench_startup(rounds: int = 5) -> Tuple[float, float]:
+    """
+    downloader の import にかかる時間 (-X importtime の累計、ミリ秒) と、
+    何もすることが無いときの downloader.py --skip の実行時間 (秒) の最小値
+
+    import しただけで LAZY_MODULES が読み込まれていないことも確かめる
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    check = (f"import sys, downloader; "
+             f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))")
+    loaded = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True,
+                            check=True, cwd=here).stdout.strip()
+    assert not loaded, f"imported eagerly: {loaded}"
+
+    imports, runs = [], []
+    with temporary_database() as path:
+        env = dict(os.environ, JNVADB_PATH=path)
+        for _ in range(rounds):
+            stderr = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", "import downloader"],
+                capture_output=True, text=True, check=True, cwd=here, env=env).stderr
+            # 最後の行が downloader 自身 ("import time: self | cumulative | downloader")
+            imports.append(int(stderr.strip().splitlines()[-1].split("|")[1]) / 1000)
+
+            start = perf_counter()
+            subprocess.run([sys.executable, "downloader.py", "--skip"],
+                           capture_output=True, check=True, cwd=here, env=env)
+            runs.append(perf_counter() - start)
+
+    return min(imports), min(runs)
+
+
+def bench_commits(threads: int = 300, posts: int = 200,
+                  every: int = 50) -> Tuple[float, float, float, int]:
+    """
+    threads 個のスレッドのレスを書き込む時間 (秒) を、これまでの接続 (ロールバックジャーナル、
+    スレッドごとにコミット) と WAL + グループコミットで比べる
+
+    最後に WAL で、別の接続から読み続けながら書き込み、失敗した読み出しの回数も返す
+    """
+    rows = [[(key, n, "名無しさん", "2023-06-19", "aBcD", "本文" * 20) for n in range(1, posts + 1)]
+            for key in range(threads)]
+    timings = []
+    errors = 0
+    for mode in ("rollback", "wal", "wal+reader"):
+        with temporary_database() as path:
+            if mode == "rollback":
+                conn = sqlite3.connect(path)
+                conn.execute("PRAGMA journal_mode = DELETE")
+                conn.execute("PRAGMA synchronous = FULL")
+                committer = GroupCommit(conn.commit, 1)
+            else:
+                conn = connect(path, synchronous=args.synchronous)
+                committer = GroupCommit(conn.commit, every)
+
+            stop = threading.Event()
+
+            def read():
+                nonlocal errors
+                with closing(connect(path, readonly=True)) as reader:
+                    while not stop.is_set():
+                        try:
+                            reader.execute("SELECT max(rowid) FROM messages").fetchone()
+                        except sqlite3.OperationalError:
+                            errors += 1
+                        sleep(0.001)
+
+            reader_thread = threading.Thread(target=read)
+            if mode == "wal+reader":
+                reader_thread.start()
+            start = perf_counter()
+            for thread_rows in rows:
+                conn.executemany(INSERT_POSTS, thread_rows)
+                committer.tick()
+            committer.flush()
+            timings.append(perf_counter() - start)
+            stop.set()
+            if reader_thread.is_alive():
+                reader_thread.join()
+            conn.close()
+
+    return timings[0], timings[1], timings[2], errors
+
+
+def pairs(keys: Tuple[str, ...], values) -> Dict[str, float]:
+    return dict(zip(keys, values))
+
+
+# 名前: 計測して {指標: 値} を返す関数 (指標の名前の末尾は単位)
+SUITES = {
+    "download": lambda: pairs(
+        ("download_serial_threads_per_sec", "download_concurrent_threads_per_sec"),
+        bench_download()),
+    "throttling": bench_throttling,
+    "parse": lambda: {
+        f"parse_{engine}_{n}_posts_ms": secs * 1000
+        for engine, timings in bench_parse().items() for n, secs in timings.items()},
+    "timestamps": lambda: {
+        f"timestamps_{key}_{impl}_ms_per_100k": secs * 1000
+        for key, timings in bench_timestamps().items()
+        for impl, secs in zip(("strptime", "cached"), timings)},
+    "memory": lambda: pairs(
+        ("convert_batch_peak_dict_mib", "convert_batch_peak_record_mib"), bench_memory()),
+    "extract": lambda: pairs(
+        ("extract_find5ch_500_ms", "extract_kakolog_500_ms"),
+        (secs * 1000 for secs in bench_extract())),
+    "difference": lambda: pairs(
+        ("difference_legacy_ms", "difference_indexed_ms"),
+        (secs * 1000 for secs in bench_difference()[:2])),
+    "insert_indexes": lambda: pairs(
+        ("insert_indexes_per_row_sec", "insert_indexes_executemany_sec"),
+        bench_insert_indexes()),
+    "chunked": bench_chunked,
+    "commits": lambda: pairs(
+        ("commit_per_thread_sec", "commit_wal_grouped_sec", "commit_wal_with_reader_sec",
+         "wal_reader_errors"),
+        bench_commits()),
+    "index": lambda: pairs(
+        ("index_serial_sec", "index_collector_sec", "index_serial_upserts",
+         "index_collector_upserts"),
+        bench_index()),
+    "convert": lambda: pairs(
+        ("convert_threads_per_sec", "convert_posts_per_sec"), bench_convert()),
+    "streaming": bench_streaming,
+    "pipeline": lambda: pairs(
+        ("download_convert_phased_sec", "download_convert_pipelined_sec"), bench_pipeline()),
+    "full_run": lambda: {
+        "full_run_find5ch_sec": bench_full_run(),
+        "full_run_kakolog_sec": bench_full_run(kakolog=True)},
+    "startup": lambda: pairs(
+        ("startup_import_ms", "startup_skip_run_sec"), bench_startup()),
+    "search": lambda: pairs(
+        ("search_like_20_hits_ms", "search_fts_20_hits_ms",
+         "search_like_rare_ms", "search_fts_rare_ms"),
+        (secs * 1000 for secs in bench_search())),
+}
+
+
+def revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record(path: str, results: Dict[str, float]) -> Dict[str, float]:
+    """
+    results を path に追記し、前回の記録の結果を返す
+    """
+    previous: Dict[str, float] = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    previous = json.loads(line)["results"]
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "revision": revision(),
+            "python": platform.python_version(),
+            "args": downloader_argv,
+            "results": results,
+        }, ensure_ascii=False) + "\n")
+    return previous
+
+
+if __name__ == "__main__":
+    bench_args, downloader_argv = bench_parser.parse_known_args()
+    parse_args(downloader_argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    results: Dict[str, float] = {}
+    for name, suite in SUITES.items():
+        if bench_args.only and name not in bench_args.only:
+            continue
+        for key, value in suite().items():
+            results[key] = value
+            print(f"{key:40}: {value:12.3f}", flush=True)
+
+    if bench_args.record:
+        previous = record(bench_args.record, results)
+        changed = [key for key in results if previous.get(key)]
+        if changed:
+            print(f"\nchange from the previous record in {bench_args.record}:")
+        for key in changed:
+            print(f"{key:40}: {(results[key] / previous[key] - 1) * 100:+8.1f} %")
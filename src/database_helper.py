@@ -4,9 +4,19 @@ import os
 import traceback
 from sqlite3 import OperationalError
 from textwrap import dedent
+from time import perf_counter
+from typing import Dict, List
 
+from modules.argments import args, parse_args
 from modules.color import Color as c
 from modules.classes import Database
+from modules.compression import RawTextCodec, markup_digest, train_dictionary
+
+# 保存済みのレスを全文検索の索引に入れる
+FTS_BACKFILL = """
+    INSERT INTO messages_fts (message, name, uid, bbskey, number)
+    SELECT message, name, uid, bbskey, number FROM messages
+"""
 
 
 class DBCreation(Database):
@@ -26,13 +36,193 @@ class DBCreation(Database):
                 resnum INTEGER NOT NULL,
                 created TEXT NOT NULL,
                 updated TEXT NOT NULL,
-                raw_text TEXT NOT NULL,
+                is_live INTEGER NOT NULL DEFAULT 1,
+                archived_max_number INTEGER,
                 UNIQUE(bbs, bbskey)
             )
             """))
 
+        return self
+
+    def __thread_indexes_indexes(self):
+        """
+        差分のビューが thread_indexes の該当する行だけを読むようにするインデックス
+
+        `archived_max_number` はアーカイブ済みの最大のレス番号で、convert() が更新する。
+        まだ一つもレスを変換していないスレッドでは NULL になる。
+        """
+
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS thread_indexes_bbskey ON thread_indexes(bbskey)")
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS thread_indexes_unarchived "
+            "ON thread_indexes(bbskey) WHERE archived_max_number IS NULL")
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS thread_indexes_live "
+            "ON thread_indexes(updated) WHERE is_live = 1 AND resnum < 1002")
+
+        return self
+
+    def __thread_raw(self):
+        """
+        ダウンロードしたスレッドの生の HTML を格納する
+
+        thread_indexes のスキャンで巨大な HTML を読まずに済むよう、別のテーブルに分ける
+        """
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TABLE IF NOT EXISTS thread_raw(
+                bbskey INTEGER PRIMARY KEY,
+                digest TEXT NOT NULL,
+                raw_text BLOB NOT NULL,
+                pending INTEGER NOT NULL DEFAULT 1
+            )
+            """))
+
+        # convert() は変換待ちのスレッドだけを読む
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS thread_raw_pending ON thread_raw(bbskey) WHERE pending = 1")
+
+        return self
+
+    def __http_validators(self):
+        """
+        条件付きリクエストに使う、URL ごとの ETag / Last-Modified を格納する
+        """
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TABLE IF NOT EXISTS http_validators(
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT
+            )
+            """))
+
+        return self
+
+    def __messages_fts(self):
+        """
+        `messages` の本文、名前、ID を全文検索するための FTS5 のテーブル
+
+        日本語は単語で区切れないので trigram で索引を作る。
+        `messages` には INTEGER PRIMARY KEY が無く VACUUM で rowid が変わりうるので、
+        外部コンテンツにはせず、`bbskey` と `number` を一緒に持たせる。
+        レスは追加されるだけなので、追加のトリガーで索引を更新する。
+        既存のデータベースに新しく作ったときは、保存済みのレスも索引に入れる。
+        """
+
+        exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        try:
+            self.cursor.execute(dedent(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    message,
+                    name,
+                    uid,
+                    bbskey UNINDEXED,
+                    number UNINDEXED,
+                    tokenize = 'trigram'
+                )
+                """))
+        except OperationalError as error:
+            print(f"全文検索のテーブルを作れませんでした (SQLite 3.34 以降が必要です): {error}")
+            return self
+
+        if not exists:
+            self.cursor.execute(dedent(FTS_BACKFILL))
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts (message, name, uid, bbskey, number)
+                VALUES (new.message, new.name, new.uid, new.bbskey, new.number);
+            END
+            """))
+
+        return self
+
+    def __crawl_cursors(self):
+        """
+        ページ送りでインデックスを取得するときの、次に取得するページを格納する
+        """
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TABLE IF NOT EXISTS crawl_cursors(
+                source TEXT NOT NULL,
+                query TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                updated TEXT NOT NULL,
+                PRIMARY KEY(source, query)
+            )
+            """))
+
+        return self
+
+    def __crawl_jobs(self):
+        """
+        スレッドのダウンロードの作業表
+
+        中断しても次回は pending / failed の行から続け、差分のビューを計算し直さない。
+        失敗したスレッドは next_eligible まで待ってから (指数的に間隔を延ばして) 再試行する
+        """
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TABLE IF NOT EXISTS crawl_jobs(
+                bbskey INTEGER PRIMARY KEY,
+                server TEXT NOT NULL,
+                bbs TEXT NOT NULL,
+                title TEXT NOT NULL,
+                since INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                next_eligible TEXT NOT NULL DEFAULT (datetime('now')),
+                updated TEXT NOT NULL DEFAULT (datetime('now'))
+            )
+            """))
         self.cursor.execute(
-            'ALTER TABLE thread_indexes ADD is_live INTEGER NOT NULL DEFAULT 1')
+            "CREATE INDEX IF NOT EXISTS crawl_jobs_unfinished "
+            "ON crawl_jobs(next_eligible) WHERE status != 'done'")
+
+        return self
+
+    def __export_marks(self):
+        """
+        書き出し (export.py) の出力先ごとに、スレッドのどのレスまで書き出したかを格納する
+        """
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TABLE IF NOT EXISTS export_marks(
+                target TEXT NOT NULL,
+                bbskey INTEGER NOT NULL,
+                number INTEGER NOT NULL,
+                PRIMARY KEY(target, bbskey)
+            )
+            """))
+
+        return self
+
+    def __raw_text_dictionaries(self):
+        """
+        raw_text の圧縮に使う辞書を格納する (modules.compression)
+        """
+
+        self.cursor.execute(dedent(
+            """
+            CREATE TABLE IF NOT EXISTS raw_text_dictionaries(
+                id INTEGER PRIMARY KEY,
+                codec TEXT NOT NULL,
+                data BLOB NOT NULL
+            )
+            """))
 
         return self
 
@@ -60,22 +250,20 @@ class DBCreation(Database):
         """
         差分をとるのに必要なビューを作成する
 
-        テーブル `messages` にある `bbskey` カラムにあるレコードの重複を除くと、変換済みのスレッドの `bbskey` を抽出できる。
-        それをテーブル thread_indexes 側の `bbskey` と差分を取ったものが変換するべきスレッドといえる。
+        `archived_max_number` が NULL のスレッドは、まだ変換していないスレッドといえる。
         しかし、それでは更新分に対応できないので、
         - `is_live = 1` かつ
         - 埋められていないスレッド（レスが1002未満） かつ
         - APIから拾える `is_live = 1` の値が毎回変動するので、14 日以内でないスレッドは既に過去ログにあるものとして無視し、
         これらに合致する `bbskey` を抽出した上で、`UNION` 句でそれと合成し取得するビューを作成する。
+        どちらも部分インデックスで引けるので、`messages` を読む必要はない。
         """
-        # self.cursor.execute(
-        #     'DROP VIEW IF EXISTS difference_bbskey')
 
         self.cursor.execute(dedent(
             '''
-            CREATE VIEW difference_bbskey AS
+            CREATE VIEW IF NOT EXISTS difference_bbskey AS
             SELECT bbskey FROM thread_indexes
-                EXCEPT SELECT DISTINCT bbskey FROM messages
+                WHERE archived_max_number IS NULL
             UNION
             SELECT bbskey FROM thread_indexes
                 WHERE is_live = 1 AND resnum < 1002 AND datetime('now','-14 days') < updated
@@ -89,28 +277,33 @@ class DBCreation(Database):
         スレッドのダウンロード時に使用
 
         アーカイブ済みの場所にある bbskey とインデックスのそれの差分
+        difference_bbskey と同じ条件を、thread_indexes との結合なしに引く
         """
 
         self.cursor.execute(dedent(
             """
             CREATE VIEW IF NOT EXISTS difference AS
-            SELECT
-                server,
-                bbs,
-                thread_indexes.bbskey,
-                title
-            FROM
-                difference_bbskey
-                INNER JOIN
-                    thread_indexes
-                ON  thread_indexes.bbskey = difference_bbskey.bbskey
+            SELECT server, bbs, bbskey, title FROM thread_indexes
+                WHERE archived_max_number IS NULL
+            UNION
+            SELECT server, bbs, bbskey, title FROM thread_indexes
+                WHERE is_live = 1 AND resnum < 1002 AND datetime('now','-14 days') < updated
+            ORDER BY bbskey
             """))
 
         return self
 
     def create_tables(self):
         self.__thread_indexes()
+        self.__thread_indexes_indexes()
+        self.__thread_raw()
         self.__messages()
+        self.__messages_fts()
+        self.__raw_text_dictionaries()
+        self.__crawl_cursors()
+        self.__crawl_jobs()
+        self.__http_validators()
+        self.__export_marks()
 
         return self
 
@@ -121,6 +314,233 @@ class DBCreation(Database):
         return self
 
 
+# 移行前と同じく、差分のビューにあるスレッドだけを変換待ちにする
+BACKFILL_PENDING = """
+    UPDATE thread_raw SET pending = (bbskey IN (SELECT bbskey FROM difference))
+"""
+
+
+class DBMigration(DBCreation):
+
+    def raw_text_stats(self) -> Dict[str, float]:
+        """
+        データベースの大きさと、raw_text を展開込みで全て読み出す速さを測る
+        """
+        page_count, = self.cursor.execute("PRAGMA page_count").fetchone()
+        page_size, = self.cursor.execute("PRAGMA page_size").fetchone()
+        stored, = self.cursor.execute(
+            "SELECT TOTAL(length(CAST(raw_text AS BLOB))) FROM thread_raw").fetchone()
+
+        codec = RawTextCodec.from_connection(self.connect)
+        start = perf_counter()
+        rows = 0
+        for raw, in self.connect.execute("SELECT raw_text FROM thread_raw"):
+            codec.decode(raw)
+            rows += 1
+        elapsed = perf_counter() - start
+
+        return {
+            "file_mib": page_count * page_size / 2**20,
+            "raw_text_mib": stored / 2**20,
+            "read_threads_per_sec": rows / elapsed if elapsed else 0.0,
+        }
+
+    def add_dictionary(self, codec: str, samples: int = 200) -> int:
+        """
+        保存済みの HTML から圧縮用の辞書を作って登録し、その id を返す
+        """
+        codec_ = RawTextCodec.from_connection(self.connect)
+        markups = [
+            codec_.decode(raw) for raw, in self.connect.execute(
+                "SELECT raw_text FROM thread_raw WHERE raw_text != '' "
+                "ORDER BY random() LIMIT ?", (samples,))
+        ]
+        self.cursor.execute(
+            "INSERT INTO raw_text_dictionaries (codec, data) VALUES (?, ?)",
+            (codec, train_dictionary(codec, markups)))
+        return self.cursor.lastrowid
+
+    def compress_raw_text(self, codec: str, batch: int = 100):
+        """
+        保存済みの raw_text を展開し、codec で圧縮し直す
+        """
+        codec_ = RawTextCodec.from_connection(self.connect, codec)
+        rowids = [r for r, in self.connect.execute(
+            "SELECT bbskey FROM thread_raw WHERE raw_text != ''")]
+
+        for i in range(0, len(rowids), batch):
+            for rowid in rowids[i:i + batch]:
+                raw, = self.cursor.execute(
+                    "SELECT raw_text FROM thread_raw WHERE bbskey = ?", (rowid,)).fetchone()
+                self.cursor.execute(
+                    "UPDATE thread_raw SET raw_text = ? WHERE bbskey = ?",
+                    (codec_.encode(codec_.decode(raw)), rowid))
+            self.commit()
+            print(f"{min(i + batch, len(rowids))}/{len(rowids)} 件を圧縮しました")
+
+        return self
+
+    def split_raw_text(self, batch: int = 100):
+        """
+        thread_indexes.raw_text を thread_raw に移し、thread_indexes からその列を消す
+        """
+        if "raw_text" not in self.columns("thread_indexes"):
+            print("移行済みです")
+            return self
+
+        codec = RawTextCodec.from_connection(self.connect)
+        bbskeys = [k for k, in self.connect.execute(
+            "SELECT bbskey FROM thread_indexes WHERE raw_text != ''")]
+
+        for i in range(0, len(bbskeys), batch):
+            for bbskey in bbskeys[i:i + batch]:
+                raw, = self.cursor.execute(
+                    "SELECT raw_text FROM thread_indexes WHERE bbskey = ?", (bbskey,)).fetchone()
+                self.cursor.execute(
+                    "INSERT OR REPLACE INTO thread_raw (bbskey, digest, raw_text) "
+                    "VALUES (?, ?, ?)",
+                    (bbskey, markup_digest(codec.decode(raw)), raw))
+            self.commit()
+            print(f"{min(i + batch, len(bbskeys))}/{len(bbskeys)} 件を移しました")
+
+        self.cursor.execute(BACKFILL_PENDING)
+
+        self.cursor.execute("ALTER TABLE thread_indexes DROP COLUMN raw_text")
+        self.commit()
+        return self
+
+    def index_stats(self, rounds: int = 3) -> Dict[str, float]:
+        """
+        インデックスに対するクエリの速さ (秒) を測る
+        """
+        queries = {
+            "difference_sec": "SELECT * FROM difference",
+            "fetch_all_available_sec": "SELECT server, bbs, bbskey, title FROM thread_indexes",
+        }
+        stats = {}
+        for key, query in queries.items():
+            timings = []
+            for _ in range(rounds):
+                start = perf_counter()
+                self.cursor.execute(query).fetchall()
+                timings.append(perf_counter() - start)
+            stats[key] = min(timings)
+        return stats
+
+    def columns(self, table: str) -> List[str]:
+        """
+        テーブルの列の名前 (テーブルが無ければ空)
+        """
+        return [r[1] for r in self.cursor.execute(f"PRAGMA table_info({table})")]
+
+    def add_column(self, table: str, column: str, definition: str, backfill: str = ""):
+        """
+        既存のテーブルに列が無ければ追加し、backfill の SQL で埋める
+
+        テーブル自体が無いときは、create_tables() が作るので何もしない
+        """
+        columns = self.columns(table)
+        if columns and column not in columns:
+            self.cursor.execute(f"ALTER TABLE {table} ADD {column} {definition}")
+            if backfill:
+                self.cursor.execute(dedent(backfill))
+            self.commit()
+        return self
+
+    def add_missing_columns(self):
+        self.add_column(
+            "thread_indexes", "archived_max_number", "INTEGER",
+            """
+            UPDATE thread_indexes SET archived_max_number = (
+                SELECT MAX(number) FROM messages
+                WHERE messages.bbskey = thread_indexes.bbskey
+            )
+            """)
+        self.add_column(
+            "thread_raw", "pending", "INTEGER NOT NULL DEFAULT 1", BACKFILL_PENDING)
+        return self
+
+    def rebuild_fts(self):
+        """
+        全文検索の索引を `messages` から作り直す
+        """
+        self.cursor.execute("DELETE FROM messages_fts")
+        self.cursor.execute(dedent(FTS_BACKFILL))
+        self.cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        self.commit()
+        return self
+
+    def drop_views(self):
+        self.cursor.execute("DROP VIEW IF EXISTS difference")
+        self.cursor.execute("DROP VIEW IF EXISTS difference_bbskey")
+        return self
+
+    def explain_difference(self) -> str:
+        return "\n".join(
+            r[3] for r in self.cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM difference"))
+
+    def vacuum(self):
+        self.commit()
+        self.cursor.execute("VACUUM")
+        return self
+
+
+def migrate(name: str):
+    """
+    既存のデータベースを移行する
+    """
+    db = DBMigration()
+    before: Dict[str, float] = {}
+    after: Dict[str, float] = {}
+
+    if name == "index-difference":
+        # 置き換える前のビューで測る
+        before = db.index_stats()
+        print(db.explain_difference(), end="\n\n")
+        db.drop_views()
+
+    elif name == "upgrade":
+        # CREATE VIEW IF NOT EXISTS では古いビュー (messages を読むもの) が残るので、作り直す
+        db.drop_views()
+
+    # 追加した列やテーブル、インデックスは、既存のデータベースにも作っておく
+    db.add_missing_columns().create_tables().create_views().commit()
+
+    if name == "index-difference":
+        db.cursor.execute("ANALYZE")
+        after = db.index_stats()
+        print(db.explain_difference(), end="\n\n")
+
+    elif name == "fts":
+        start = perf_counter()
+        db.rebuild_fts()
+        count, = db.cursor.execute("SELECT count(*) FROM messages_fts").fetchone()
+        print(f"{count} 件のレスの索引を {perf_counter() - start:.1f} 秒で作りました")
+
+    elif name == "upgrade" and "raw_text" in db.columns("thread_indexes"):
+        # 生の HTML が thread_indexes に残っていると (raw_text は NOT NULL)、目次を追加できない
+        print("生の HTML を thread_indexes から thread_raw に移します")
+        before = db.index_stats()
+        after = db.split_raw_text().vacuum().index_stats()
+
+    elif name == "split-raw-text":
+        before = db.index_stats()
+        after = db.split_raw_text().vacuum().index_stats()
+
+    elif name == "compress-raw-text":
+        before = db.raw_text_stats()
+        if args.train_dictionary:
+            dict_id = db.add_dictionary(args.compress)
+            db.commit()
+            print(f"辞書 (id: {dict_id}) を登録しました")
+        after = db.compress_raw_text(args.compress).vacuum().raw_text_stats()
+
+    for key in before:
+        print(f"{key:>24}: {before[key]:12.4f} -> {after[key]:12.4f}")
+
+    db.close()
+
+
 def create_database():
     """
     データベースを作成し、テーブルとビューを作成する
@@ -158,5 +578,9 @@ def create_database():
 
 
 if __name__ == "__main__":
+    parse_args()
 
-    create_database()
+    if args.migrate:
+        migrate(args.migrate)
+    else:
+        create_database()
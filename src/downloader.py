@@ -1,111 +1,304 @@
 #!/usr/bin/env python3
+"""
+インデックスを取得し、スレッドをダウンロードして変換する
+
+cron から頻繁に動かしても軽く済むよう、requests や bs4 などの重いモジュールは
+それが要る段階になってから import する
+"""
 import logging
 import sqlite3
 import sys
-from time import sleep
-from contextlib import closing
-from modules.argments import args
-from modules.vars import JNVADB_PATH
-from modules.errors import DownloadError
-from modules.classes import Converter, ThreadsDownloader, ThreadsIndexer, ConverterDB
+from time import perf_counter
+from contextlib import ExitStack, closing
+from typing import TYPE_CHECKING, Dict, Sequence, Tuple
+from modules.argments import args, parse_args
+from modules.vars import jnvadb_path
+from modules.connection import GroupCommit, connect
+from modules.metrics import METRICS
 
-logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+if TYPE_CHECKING:
+    from modules.classes import ConverterDB
 
+# --skip のときに、取得か変換をするものが残っているかどうか
+# (作業表で今取得してよいスレッド、差分のビューのうち再試行を待っていないスレッド、変換待ちのスレッド)
+PENDING_WORK = """
+SELECT EXISTS (
+        SELECT 1 FROM crawl_jobs
+        WHERE status != 'done' AND next_eligible <= datetime('now'))
+    OR EXISTS (
+        SELECT 1 FROM difference
+        WHERE NOT EXISTS (
+            SELECT 1 FROM crawl_jobs
+            WHERE crawl_jobs.bbskey = difference.bbskey
+                AND status != 'done' AND next_eligible > datetime('now')))
+    OR EXISTS (SELECT 1 FROM thread_raw WHERE pending = 1)
+"""
 
-def convert() -> None:
-    if JNVADB_PATH is not None:
-        with closing(sqlite3.connect(JNVADB_PATH)) as conn:
-            with conn:
-                keys = conn.execute("SELECT bbskey FROM difference").fetchall()
 
-                if keys:
-                    logging.info("Started the conversion from raw HTML files")
-                    logging.debug("%s", keys)
+def has_pending_work(path: str) -> bool:
+    with closing(connect(path)) as conn:
+        return bool(conn.execute(PENDING_WORK).fetchone()[0])
 
-                    for k in keys:
-                        bbs_key, title, text = conn.execute(
-                            "SELECT bbskey, title, raw_text "
-                            "FROM thread_indexes WHERE bbskey = ?", k) \
-                            .fetchone()
-                        logging.info("Thread conversion %s (%s) started", bbs_key, title)
 
-                        thread = Converter(bbs_key=bbs_key, markup=text)
-                        threads = thread.convert()
-                        logging.info("Thread conversion %s (%s) success", bbs_key, title)
+def convert(db: "ConverterDB | None" = None, workers: int = 1, commit_every: int = 1,
+            commit_interval: float = 0) -> Tuple[int, float]:
+    """
+    変換待ち (thread_raw.pending = 1) のスレッドを変換し、(変換したスレッド数, 秒数) を返す
 
-                        logging.info("Saving the archive of thread %s ...", bbs_key)
-                        conn.executemany(
-                            "INSERT OR IGNORE INTO messages "
-                            "VALUES (:bbskey, :number, :name, :date, :uid, :message)",
-                            threads.values(),
-                        )
-                        logging.info("Saving the archive of thread %s success", bbs_key)
-                        conn.commit()
+    db を省略したときは、環境変数 JNVADB_PATH のデータベースに接続する。
+    workers が 2 以上のときは、変換をプロセスプールで並列に行い、
+    このプロセスだけがレスを書き込んで commit_every スレッドか commit_interval 秒ごとにコミットする
+    """
+    from modules.classes import (
+        ConverterDB,
+        INSERT_POSTS,
+        MARK_CONVERTED,
+        UPDATE_ARCHIVED_MAX_NUMBER,
+        convert_markup,
+    )
 
-                logging.info("All threads was safely saved")
+    if db is None:
+        if jnvadb_path() is None:
+            return 0, 0.0
+        with closing(ConverterDB()) as db_:
+            return convert(db_, workers, commit_every, commit_interval)
 
+    converted_threads = 0
+    start = perf_counter()
+    conn = db.connect
+    with conn:
+        pending = db.count_pending()
+
+        if pending:
+            logging.info("Started the conversion from raw HTML files (%d threads)", pending)
+
+            # 生の HTML は少しずつ読み、変換して書き込んだものから手放す
+            rows = (
+                (bbs_key, title, db.codec.decode(raw), args.parser)
+                for bbs_key, title, raw in db.iter_pending_raw()
+            )
+
+            committer = GroupCommit(db.commit, commit_every, commit_interval)
+            with ExitStack() as stack:
+                if workers > 1:
+                    from concurrent.futures import ProcessPoolExecutor
+                    from modules.pool import bounded_map
+
+                    executor = stack.enter_context(ProcessPoolExecutor(workers))
+                    converted = bounded_map(executor, convert_markup, rows, workers * 2)
+                else:
+                    converted = (convert_markup(*row) for row in rows)
+
+                for n, (bbs_key, title, posts) in enumerate(converted, 1):
+                    logging.info("Thread conversion %s (%s) success", bbs_key, title)
+
+                    logging.info("Saving the archive of thread %s ...", bbs_key)
+                    with METRICS.time("db_write"):
+                        conn.executemany(INSERT_POSTS, posts)
+                        conn.execute(UPDATE_ARCHIVED_MAX_NUMBER, {"bbskey": bbs_key})
+                        conn.execute(MARK_CONVERTED, {"bbskey": bbs_key})
+                    METRICS.add("posts", len(posts))
+                    METRICS.add("threads")
+                    logging.info("Saving the archive of thread %s success", bbs_key)
+                    converted_threads = n
+                    committer.tick()
+
+            committer.flush()
+
+        logging.info("All threads was safely saved")
+
+    return converted_threads, perf_counter() - start
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    """
+    argv (省略したときは sys.argv) を引数として、取得から変換までを行う
+    """
+    parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.DEBUG)
+
+    path = jnvadb_path()
+    if args.skip and not args.force_archive and path is not None \
+            and not has_pending_work(path):
+        logging.info("取得も変換もするスレッドがありません")
+        return
+
+    from modules.classes import (
+        Converter,
+        ConcurrentThreadsDownloader,
+        ConverterDB,
+        ThreadsDownloader,
+    )
+    from modules.collector import DEFAULT_QUERY, IndexCollector
+    from modules.errors import DownloadError
+    from modules.httpcache import NOT_MODIFIED
+    from modules.ratecontrol import AdaptiveRateController
 
-if __name__ == "__main__":
     # インデックスの取得
     db = ConverterDB()
-    if args.skip:
-        dict_retrieved = {}
-    else:
-        indx = ThreadsIndexer(args.query)
+    http_cache = None if args.no_http_cache else db.load_http_cache()
+    collector = IndexCollector(
+        args.query or [DEFAULT_QUERY],
+        (args.source or ([] if args.kakolog else ["find"])) + (["kakolog"] if args.kakolog else []),
+        http_cache,
+        args.index_interval,
+    )
+    if not args.skip:
+        # 過去ログは、前回中断したページの続きから取得する
+        starts = {q: db.load_cursor("kakolog", q) for q in collector.queries}
         logging.info("インデックスを取得します")
-        dict_retrieved = indx.get_index()
         try:
-            if dict_retrieved is None:
-                raise ValueError
-            dict_retrieved = {x: dict_retrieved[x] for x in reversed(dict_retrieved)}
-        except KeyboardInterrupt as e:
+            # インデックスから取得したデータを、取得できたものからデータベースに追加する
+            with closing(collector.iter_batches(starts)) as batches:
+                for batch in batches:
+                    if batch.next_page is not None:
+                        # 次のページの位置は、このページの目次と同じトランザクションでコミットされる
+                        db.save_cursor(batch.source, batch.query, batch.next_page)
+                    db.insert_indexes(batch.threads).commit()
+            for query, (_, exhausted) in collector.cursors.items():
+                if exhausted:
+                    db.clear_cursor("kakolog", query)
+            if http_cache is not None:
+                for url in collector.urls:
+                    db.save_validator(url, http_cache)
+            db.commit()
+        except KeyboardInterrupt:
             db.close()
             sys.exit(1)
-        except ValueError:
+        except sqlite3.OperationalError as e:
+            # 閉じたデータベースでダウンロードを続けても失敗するだけなので、ここでやめる
+            logging.error("インデックスを保存できませんでした: %s", e)
+            db.close()
+            sys.exit(1)
+        if collector.failures and not collector.fetched:
             db.close()
             sys.exit(1)
-
-    try:
-        # インデックスから取得したデータをデータベースに追加し、必要な分だけ更新する
-        db.insert_indexes(dict_retrieved).commit()
-    except sqlite3.OperationalError as e:
-        db.close()
 
     # スレッドのダウンロード
-    downloader = ThreadsDownloader()
-    # raw_text が埋まっていないものだけ、そうでなければ増減ダウンロード
-    if args.force_archive is True:
-        posts = db.fetch_all_available()  # [(0, 1, 2), ]
+    # 間隔はサーバーごとに空け、応答に合わせて広げたり縮めたりする
+    jobs = max(args.jobs, 1)
+    if args.fixed_rate:
+        rate = AdaptiveRateController(args.sleep, concurrency=jobs)
+    else:
+        rate = AdaptiveRateController(
+            args.sleep, min(args.min_sleep, args.sleep), max(args.max_sleep, args.sleep),
+            max_concurrency=jobs)
+    if args.jobs > 1 or args.pipeline:
+        # ワーカーが先読みするので、変換している間も次のスレッドのダウンロードが進む
+        downloader = ConcurrentThreadsDownloader(jobs, args.sleep, http_cache, rate)
     else:
-        posts = db.fetch_only_resumable()
-    if posts:
+        downloader = ThreadsDownloader(http_cache, rate)
+    # 前回の作業表に残っているスレッドがあれば、差分のビューを計算し直さずに続きから取得する
+    # (--convert-only では取得しないので積まない。積むと次回は古い作業表から取得してしまう)
+    if not args.convert_only and (args.force_archive is True or not db.has_jobs()):
+        # raw_text が埋まっていないものだけ、そうでなければ増減ダウンロード
+        if args.force_archive is True:
+            targets = db.iter_all_available()
+        elif args.incremental:
+            targets = db.iter_resumable_since()
+        else:
+            targets = db.iter_only_resumable()
+        db.enqueue_jobs(targets).commit()
+    # 差分取得するスレッドの、アーカイブ済みの最大のレス番号
+    # (先読みされてから書き込まれるまでの間だけ持つ)
+    since: Dict[int, int] = {}
+
+    def iter_targets():
+        """
+        作業表を少しずつ読みながら、ダウンローダーに渡す
+        """
+        for server, bbs, bbskey, title, last in db.iter_jobs():
+            if not args.incremental:
+                yield server, bbs, bbskey, title
+                continue
+            if last:
+                since[bbskey] = last
+            yield server, bbs, bbskey, title, last
+
+    queued = db.has_jobs()
+    # 内容が変わっておらず、保存も変換もしなかったスレッドの数
+    unchanged = 0
+    # 失敗して、作業表で後回しにしたスレッドの数
+    failed = 0
+    if queued:
         logging.info("スレッドを取得します")
     if not args.convert_only:
-        for resp in downloader.generate_response(posts):
-            if not resp:
-                break
-            bbskey, title, text = resp
+        # スレッドごとに fsync しないよう、まとめてコミットする (中断しても作業表から続けられる)
+        committer = GroupCommit(db.commit, args.commit_every, args.commit_interval)
+        for bbskey, title, text, url in downloader.generate_response(iter_targets()):
+            last = since.pop(bbskey, None)
             logging.info("%s ... ", title)
             try:
-                if text is None:
-                    raise DownloadError(
-                        "The page was failed to be retrieved and skipped "
-                        "due to an error while the process of downloading."
+                if isinstance(text, DownloadError):
+                    # 他のスレッドの取得は続け、このスレッドは間隔を空けて次回以降に再試行する
+                    failed += 1
+                    logging.error("Skipped: %s", "".join(text.args))
+                    db.fail_job(bbskey, "".join(text.args), args.backoff)
+                elif text == NOT_MODIFIED:
+                    # 保存済みの HTML のままでよく、変換し直す必要もない
+                    logging.info("Not modified since the last download")
+                elif last:
+                    # 生の HTML は差分しか持っていないので、レスだけを追加する
+                    db.insert_posts(
+                        Converter(bbskey, text, since=last, engine=args.parser).records()
                     )
-                db.update_raw_data(bbskey, text)
-            except (KeyboardInterrupt, DownloadError) as e:
+                else:
+                    if not db.update_raw_data(bbskey, text):
+                        unchanged += 1
+                        logging.info("Unchanged since the last download")
+                    elif args.pipeline:
+                        # 生の HTML とレスを同じトランザクションで書き込み、読み直さずに済ませる
+                        db.insert_posts(
+                            Converter(bbskey, text, engine=args.parser).records()
+                        ).mark_converted(bbskey)
+                    if http_cache is not None:
+                        db.save_validator(url, http_cache)
+                if not isinstance(text, DownloadError):
+                    db.finish_job(bbskey)
+            except KeyboardInterrupt as e:
                 db.commit().close()
                 logging.error("".join(e.args))
                 logging.error("Saved the progress of what you have downloaded.")
                 sys.exit(1)
             else:
-                db.commit()
-            sleep(args.sleep)
+                committer.tick()
 
             logging.info("Saving success")
 
-        if posts:
+        committer.flush()
+
+        if failed:
+            logging.warning("%d threads failed and will be retried later", failed)
+        elif queued:
             logging.info("スレッドの取得に成功しました")
+        for host, state in rate.summary().items():
+            logging.info("Rate for %s: every %.2f s, up to %d at a time",
+                         host, state["interval"], state["concurrency"])
+        if http_cache is not None and http_cache.requests:
+            logging.info(
+                "HTTP cache: %d / %d requests not modified (hit ratio %.1f%%)",
+                http_cache.hits, http_cache.requests, http_cache.hit_ratio * 100,
+            )
 
     # HTML の変換処理
-    convert()
+    converted_threads, elapsed = convert(
+        db, workers=args.workers, commit_every=args.commit_every,
+        commit_interval=args.commit_interval,
+    )
+    db.close()
+    if unchanged and converted_threads:
+        # 今回変換したスレッドの平均から、変換せずに済んだ時間を見積もる
+        logging.info(
+            "Skipped %d unchanged threads (about %.1f s of conversion saved)",
+            unchanged, elapsed / converted_threads * unchanged,
+        )
+    elif unchanged:
+        logging.info("Skipped %d unchanged threads", unchanged)
+
+    logging.info("Metrics: %s", METRICS.report())
+    if args.metrics:
+        METRICS.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
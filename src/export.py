@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+アーカイブしたレスを Parquet / Arrow IPC のデータセットに書き出す
+
+出力先の下に bbs=<板>/month=<年-月>/ と分けて書き出す。
+--incremental では、前回の書き出しより後に変換されたレスだけを新しいファイルとして追加する。
+"""
+import os
+import sqlite3
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from contextlib import closing
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, Iterator
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:  # pragma: no cover
+    pa = ds = None
+
+from modules.connection import connect
+from modules.vars import jnvadb_path
+
+FORMATS = {"parquet": "parquet", "arrow": "ipc"}
+
+# thread_indexes はスレッドごとに一行なので、レスの順に読めばそのまま突き合わせられる
+EXPORT_QUERY = """
+    SELECT t.bbs, CASE m.date WHEN '' THEN 'unknown' ELSE substr(m.date, 1, 7) END,
+        t.server, m.bbskey, t.title, m.number, m.name, m.date, m.uid, m.message
+    FROM thread_indexes AS t
+    LEFT JOIN export_marks AS e ON e.target = :target AND e.bbskey = t.bbskey
+    INNER JOIN messages AS m ON m.bbskey = t.bbskey AND m.number > {since}
+    WHERE t.archived_max_number > {since}
+    ORDER BY m.bbskey, m.number
+"""
+
+SAVE_MARK = """
+    INSERT INTO export_marks (target, bbskey, number) VALUES (:target, :bbskey, :number)
+    ON CONFLICT (target, bbskey) DO UPDATE SET number = excluded.number
+"""
+
+
+def schema():
+    return pa.schema([
+        ("bbs", pa.string()),
+        ("month", pa.string()),
+        ("server", pa.string()),
+        ("bbskey", pa.int64()),
+        ("title", pa.string()),
+        ("number", pa.int64()),
+        ("name", pa.string()),
+        ("date", pa.string()),
+        ("uid", pa.string()),
+        ("message", pa.string()),
+    ])
+
+
+class Exporter:
+    def __init__(self, path: str, dest: str, format: str = "parquet",
+                 chunk_size: int = 50000) -> None:
+        # write_dataset() は batches() を別のスレッドから読み進める (同時には読まない)
+        self.conn = connect(path, check_same_thread=False)
+        self.dest = dest
+        self.format = format
+        self.chunk_size = chunk_size
+        # 出力先ごとに書き出した位置を覚える
+        self.target = f"{format}:{os.path.abspath(dest)}"
+        self.rows = 0
+        # スレッドごとの書き出したレスの最大の番号
+        self.marks: Dict[int, int] = {}
+
+    def batches(self, incremental: bool) -> Iterator["pa.RecordBatch"]:
+        """
+        レスを chunk_size 件ずつ読み、RecordBatch にして返す
+        """
+        since = "coalesce(e.number, 0)" if incremental else "0"
+        cursor = self.conn.execute(
+            EXPORT_QUERY.format(since=since), {"target": self.target})
+        schema_ = schema()
+
+        while rows := cursor.fetchmany(self.chunk_size):
+            columns = list(zip(*rows))
+            bbskeys, numbers = columns[3], columns[5]
+            for bbskey, number in zip(bbskeys, numbers):
+                self.marks[bbskey] = number
+            self.rows += len(rows)
+            yield pa.RecordBatch.from_arrays(
+                [pa.array(c, type=f.type) for c, f in zip(columns, schema_)], schema=schema_)
+
+    def export(self, incremental: bool = False):
+        # 追記しても前回のファイルを上書きしないよう、実行ごとにファイル名を変える
+        run = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        extension = "parquet" if self.format == "parquet" else "arrow"
+
+        ds.write_dataset(
+            self.batches(incremental),
+            self.dest,
+            schema=schema(),
+            format=FORMATS[self.format],
+            partitioning=["bbs", "month"],
+            partitioning_flavor="hive",
+            basename_template=f"part-{run}-{{i}}.{extension}",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+        # 書き出し終えてから位置を進める (途中で失敗したら次回もう一度書き出す)
+        self.conn.executemany(SAVE_MARK, (
+            {"target": self.target, "bbskey": bbskey, "number": number}
+            for bbskey, number in self.marks.items()))
+        self.conn.commit()
+        return self
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="アーカイブしたレスを Parquet / Arrow IPC に書き出す",
+        formatter_class=RawTextHelpFormatter,
+    )
+    parser.add_argument("dest", help="書き出すディレクトリ", metavar="dest")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=tuple(FORMATS),
+        default="parquet",
+        help="書き出す形式 (既定: %(default)s)",
+        required=False,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="前回この出力先に書き出した後に変換されたレスだけを書き出す",
+        required=False,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=50000,
+        help="一度に読み込むレスの件数 (既定: %(default)s件)",
+        metavar="num",
+        required=False,
+        type=int,
+    )
+    args = parser.parse_args()
+
+    if pa is None:
+        print("pyarrow がインストールされていません (pip install jnva-scraping[export])")
+        sys.exit(1)
+
+    if (path := jnvadb_path()) is None:
+        sys.exit(1)
+
+    exporter = Exporter(path, args.dest, args.format, args.chunk_size)
+    with closing(exporter.conn):
+        try:
+            exporter.conn.execute("SELECT 1 FROM export_marks LIMIT 1")
+        except sqlite3.OperationalError:
+            print("'database_helper.py --migrate upgrade' を実行してください")
+            sys.exit(1)
+
+        start = perf_counter()
+        exporter.export(args.incremental)
+        elapsed = perf_counter() - start
+
+    print(
+        f"{exporter.rows} 件のレス ({len(exporter.marks)} スレッド) を "
+        f"{elapsed:.1f} 秒で書き出しました "
+        f"({exporter.rows / elapsed if elapsed else 0.0:.0f} 件/秒)"
+    )
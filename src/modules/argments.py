@@ -1,50 +1,264 @@
-from argparse import ArgumentParser, RawTextHelpFormatter
-
-parser = ArgumentParser(
-    description="スレッドをデータベースに保存する", formatter_class=RawTextHelpFormatter
-)
-parser.add_argument(
-    "-q",
-    "--query",
-    default="なんJNVA部",
-    help="検索クエリを指定 (既定:「%(default)s」)",
-    metavar="query",
-    required=False,
-)
-parser.add_argument(
-    "-s",
-    "--skip",
-    action="store_true",
-    default=False,
-    help="インデックスを取得しない (変換処理だけしたいとき便利です)",
-    required=False,
-)
-parser.add_argument(
-    "--convert-only",
-    action="store_true",
-    default=False,
-    help="すでにダウンロードしたスレッドについて変換処理だけする",
-    required=False,
-)
-parser.add_argument(
-    "-t",
-    "--sleep",
-    default=5,
-    help="どれくらいの間隔で落とすか (既定: %(default)s秒)",
-    metavar="secs",
-    required=False,
-    type=int,
-)
-parser.add_argument(
-    "-r",
-    "--max-retry",
-    default=5,
-    help="HTTPエラー発生時などの最大再試行回数 (既定: %(default)s回)",
-    metavar="tries",
-    required=False,
-    type=int,
-)
-parser.add_argument(
-    "--force-archive", action="store_true", default=False, help="", required=False
-)
-args = parser.parse_args()
+"""
+downloader.py と database_helper.py の引数
+
+import しただけでは sys.argv を読まない。args は既定値で作っておき、
+スクリプトの入り口で parse_args() を呼ぶと、その場で中身が書き換わる
+(ほかのモジュールは import した args をそのまま参照すればよい)
+"""
+from argparse import ArgumentParser, Namespace, RawTextHelpFormatter
+from typing import Sequence
+from modules.compression import CODECS, DEFAULT_CODEC
+from modules.connection import SYNCHRONOUS
+from modules.parsers import DEFAULT_PARSER, PARSERS
+
+
+def build_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="スレッドをデータベースに保存する", formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "-q",
+        "--query",
+        action="append",
+        default=None,
+        help="検索クエリを指定 (既定:「なんJNVA部」)\n"
+        "繰り返し指定すると、すべてのクエリの結果をまとめて取得する",
+        metavar="query",
+        required=False,
+    )
+    parser.add_argument(
+        "--kakolog",
+        action="store_true",
+        default=False,
+        help="インデックスを過去ログの検索から取得する (--source kakolog と同じ)\n"
+        "中断しても次回はその続きのページから取得する",
+        required=False,
+    )
+    parser.add_argument(
+        "--source",
+        action="append",
+        choices=("find", "kakolog"),
+        default=None,
+        help="インデックスの取得元 (既定: find)\n"
+        "find: find.5ch.net の検索、kakolog: 過去ログの検索\n"
+        "繰り返し指定すると、両方の結果をまとめて取得する",
+        required=False,
+    )
+    parser.add_argument(
+        "--index-interval",
+        default=1,
+        help="インデックスを取得するときの、取得元ごとのリクエストの間隔 (既定: %(default)s秒)",
+        metavar="secs",
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "-s",
+        "--skip",
+        action="store_true",
+        default=False,
+        help="インデックスを取得しない (変換処理だけしたいとき便利です)",
+        required=False,
+    )
+    parser.add_argument(
+        "--convert-only",
+        action="store_true",
+        default=False,
+        help="すでにダウンロードしたスレッドについて変換処理だけする",
+        required=False,
+    )
+    parser.add_argument(
+        "-t",
+        "--sleep",
+        default=5,
+        help="どれくらいの間隔で落とすか (既定: %(default)s秒)\n"
+        "サーバーの応答に合わせて --min-sleep から --max-sleep の間で変える",
+        metavar="secs",
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--min-sleep",
+        default=1,
+        help="サーバーが空いているときに縮める間隔の下限 (既定: %(default)s秒)",
+        metavar="secs",
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--max-sleep",
+        default=60,
+        help="サーバーが混んでいるときに広げる間隔の上限 (既定: %(default)s秒)",
+        metavar="secs",
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--fixed-rate",
+        action="store_true",
+        default=False,
+        help="間隔を --sleep のまま変えない\n"
+        "(429 / 503 の Retry-After や、失敗したあとの待ち時間は守る)",
+        required=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        help="同時にダウンロードするスレッドの数 (既定: %(default)s)\n"
+        "2 以上のときは --sleep の間隔をサーバーごとに空ける",
+        metavar="num",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "-r",
+        "--max-retry",
+        default=5,
+        help="HTTPエラー発生時などの最大再試行回数 (既定: %(default)s回)",
+        metavar="tries",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--backoff",
+        default=60,
+        help="取得に失敗したスレッドを再試行するまでの秒数 (既定: %(default)s秒)\n"
+        "失敗するたびに倍になる (最大 1 日)",
+        metavar="secs",
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="アーカイブ済みのスレッドは、新しいレスだけを取得して追加する\n"
+        "(--force-archive のときは無視される)",
+        required=False,
+    )
+    parser.add_argument(
+        "--parser",
+        choices=sorted(PARSERS),
+        default=DEFAULT_PARSER,
+        help="スレッドの HTML の変換に使うパーサー (既定: %(default)s)",
+        required=False,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        help="HTML の変換に使うプロセスの数 (既定: %(default)s)",
+        metavar="num",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--commit-every",
+        default=1,
+        help="ダウンロードや変換を何スレッドごとにコミットするか (既定: %(default)s)\n"
+        "--workers と合わせて大きくすると速くなる",
+        metavar="threads",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--commit-interval",
+        default=0,
+        help="--commit-every に達していなくても、この秒数ごとにコミットする (既定: しない)",
+        metavar="secs",
+        required=False,
+        type=float,
+    )
+
+    sqlite = parser.add_argument_group("SQLite の設定")
+    sqlite.add_argument(
+        "--synchronous",
+        choices=SYNCHRONOUS,
+        default="NORMAL",
+        help="PRAGMA synchronous (既定: %(default)s)",
+        required=False,
+    )
+    sqlite.add_argument(
+        "--cache-size",
+        default=64,
+        help="ページキャッシュの大きさ (既定: %(default)s MiB)",
+        metavar="MiB",
+        required=False,
+        type=int,
+    )
+    sqlite.add_argument(
+        "--mmap-size",
+        default=256,
+        help="メモリマップする大きさ (既定: %(default)s MiB、0 で使わない)",
+        metavar="MiB",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="ダウンロードしたスレッドをその場で変換し、生の HTML と一緒に書き込む\n"
+        "次のスレッドのダウンロードは変換と並行して進む (先読みは --jobs の 2 倍まで)",
+        required=False,
+    )
+    parser.add_argument(
+        "--compress",
+        choices=CODECS,
+        default=DEFAULT_CODEC,
+        help="生の HTML を保存するときの圧縮方式 (既定: %(default)s)",
+        required=False,
+    )
+    parser.add_argument(
+        "--no-http-cache",
+        action="store_true",
+        default=False,
+        help="ETag / Last-Modified による条件付きリクエストをしない",
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="段階ごとの所要時間や件数の集計を書き出すファイル\n"
+        "拡張子が .prom なら Prometheus のテキスト形式、それ以外は JSON",
+        metavar="path",
+        required=False,
+    )
+    parser.add_argument(
+        "--force-archive", action="store_true", default=False, help="", required=False
+    )
+
+    migration = parser.add_argument_group("データベースの移行 (database_helper.py)")
+    migration.add_argument(
+        "--migrate",
+        choices=("upgrade", "index-difference", "fts", "split-raw-text", "compress-raw-text"),
+        default=None,
+        help="upgrade: 足りない列やテーブル、インデックスを追加し、差分のビューを作り直す\n"
+        "(生の HTML が thread_indexes に残っていれば、split-raw-text も行う)\n"
+        "fts: 保存済みのレスから全文検索の索引を作り直す\n"
+        "index-difference: 差分のビューを、インデックスで引けるものに置き換える\n"
+        "split-raw-text: 生の HTML を thread_indexes から thread_raw に移す\n"
+        "compress-raw-text: 保存済みの生の HTML を --compress の方式で圧縮し直す",
+        required=False,
+    )
+    migration.add_argument(
+        "--train-dictionary",
+        action="store_true",
+        default=False,
+        help="圧縮し直す前に、保存済みの HTML から圧縮用の辞書を作る",
+        required=False,
+    )
+    return parser
+
+
+def parse_args(argv: Sequence[str] | None = None) -> Namespace:
+    """
+    argv (省略したときは sys.argv) を読んで args を書き換え、args を返す
+    """
+    vars(args).update(vars(build_parser().parse_args(argv)))
+    return args
+
+
+# parse_args() が呼ばれるまでは既定値
+args = build_parser().parse_args([])
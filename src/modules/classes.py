@@ -1,28 +1,65 @@
 import json
 import logging
-import sys
-import sqlite3
-from datetime import datetime, timedelta, timezone
-from re import findall
-from typing import Any, List, Dict, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import monotonic
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 from urllib.parse import urlparse
 import requests
-from bs4 import BeautifulSoup
-from modules.types import Response, Posts, Threads
-from modules.errors import BadContentError
+from requests.adapters import HTTPAdapter
+from modules.types import Response, Posts, PostRecord, Thread, Threads
+from modules.compression import RawTextCodec, markup_digest
+from modules.connection import connect
+from modules.errors import BadContentError, DownloadError, ThrottledError
+from modules.httpcache import NOT_MODIFIED, HttpValidatorCache
+from modules.metrics import METRICS
+from modules.parsers import get_parser
+from modules.pool import bounded_map
+from modules.ratecontrol import (
+    FAILED,
+    NEUTRAL,
+    OK,
+    THROTTLED,
+    THROTTLE_STATUSES,
+    AdaptiveRateController,
+    parse_retry_after,
+)
+from modules.streaming import CHUNK_SIZE, counted, decode_thread, response_encoding
+from modules.timestamps import bbskey_date, index_date, post_date
 from modules.argments import args
-from modules.vars import JNVADB_PATH
+from modules.vars import jnvadb_path
+
+
+# PostRecord をそのまま渡す
+INSERT_POSTS = "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)"
+
+# convert() でレスを追加したあとに、スレッドを変換済みにする
+MARK_CONVERTED = "UPDATE thread_raw SET pending = 0 WHERE bbskey = :bbskey"
+
+# convert() などでレスを追加したあとに、アーカイブ済みの最大のレス番号を更新する
+UPDATE_ARCHIVED_MAX_NUMBER = """
+    UPDATE thread_indexes
+    SET archived_max_number = (SELECT MAX(number) FROM messages WHERE bbskey = :bbskey)
+    WHERE bbskey = :bbskey
+"""
 
 
 class Database:
-    def __init__(self):
-        assert JNVADB_PATH is not None
-        self.connect = sqlite3.connect(JNVADB_PATH)
+    def __init__(self, path: str | None = None):
+        """
+        path を省略したときは、環境変数 JNVADB_PATH のデータベースに接続する
+        """
+        path = path or jnvadb_path()
+        assert path is not None
+        self.connect = connect(
+            path, synchronous=args.synchronous, cache_mib=args.cache_size, mmap_mib=args.mmap_size)
         self.cursor = self.connect.cursor()
 
     def rollback(self):
         self.connect.rollback()
 
+    @METRICS.timed("db_commit")
     def commit(self):
         self.connect.commit()
         return self
@@ -33,87 +70,310 @@ class Database:
 
 
 class ConverterDB(Database):
-    def insert_indexes(self, data: Threads):
+    def __init__(self, path: str | None = None):
+        super().__init__(path)
+        self.codec = RawTextCodec.from_connection(self.connect, args.compress)
+
+    INDEX_FIELDS = (
+        "server", "bbs", "bbskey", "title", "resnum", "created", "updated", "is_live")
+
+    @METRICS.timed("db_write")
+    def insert_indexes(self, data: Threads | Iterable[Thread], chunk_size: int = 5000):
         """
         インデックスをテーブルに挿入する
+
+        data はインデックスの辞書のほか、各スレッドの辞書を返すジェネレーターでもよく、
+        chunk_size 件ずつまとめて挿入し、そのたびにコミットする
         """
-        # raw_textは後から更新するので空っぽにしておく
-        indexes = data.values()
+        # 生の HTML は後から thread_raw に入れる
+        indexes = data.values() if isinstance(data, dict) else data
+        rows = ({k: index.get(k) for k in self.INDEX_FIELDS} for index in indexes)
 
-        for index in indexes:
-            self.cursor.execute(
+        while chunk := list(islice(rows, chunk_size)):
+            self.cursor.executemany(
                 """
                 INSERT INTO thread_indexes (
                     server, bbs, bbskey, title, resnum,
-                    created, updated, raw_text, is_live)
-                VALUES (?, ?, ?, ?, ?, ?, ?, '', ?)
+                    created, updated, is_live)
+                VALUES (
+                    :server, :bbs, :bbskey, :title, :resnum,
+                    :created, :updated, :is_live)
                 ON CONFLICT (bbs, bbskey)
                 DO UPDATE SET
-                    resnum  = ?,
-                    updated = ?,
-                    is_live = ?
+                    resnum  = excluded.resnum,
+                    updated = excluded.updated,
+                    is_live = excluded.is_live
                 """,
-                (
-                    index.get("server"),
-                    index.get("bbs"),
-                    index.get("bbskey"),
-                    index.get("title"),
-                    index.get("resnum"),
-                    index.get("created"),
-                    index.get("updated"),
-                    index.get("is_live"),
-                    index.get("resnum"),
-                    index.get("updated"),
-                    index.get("is_live"),
-                ),
+                chunk,
             )
+            self.commit()
 
         return self
 
-    def update_raw_data(self, bbs_key: str, markup: str):
+    @METRICS.timed("db_write")
+    def update_raw_data(self, bbs_key: str, markup: str) -> bool:
         """
-        生のHTMLデータをインデックスに挿入する
+        生のHTMLデータを圧縮して、内容のハッシュ値とともに thread_raw に格納する
+
+        格納したスレッドは、変換待ち (pending = 1) になる。
+        ハッシュ値が保存済みのものと同じときは何もせず、False を返す
         """
+        digest = markup_digest(markup)
+        self.cursor.execute("SELECT digest FROM thread_raw WHERE bbskey = ?", (bbs_key,))
+        if (row := self.cursor.fetchone()) is not None and row[0] == digest:
+            return False
+
         self.cursor.execute(
-            "UPDATE thread_indexes SET raw_text = :text WHERE bbskey = :bbskey", {
+            """
+            INSERT INTO thread_raw (bbskey, digest, raw_text, pending)
+            VALUES (:bbskey, :digest, :text, 1)
+            ON CONFLICT (bbskey)
+            DO UPDATE SET
+                digest   = excluded.digest,
+                raw_text = excluded.raw_text,
+                pending  = 1
+            """, {
                 "bbskey": bbs_key,
-                "text": markup
+                "digest": digest,
+                "text": self.codec.encode(markup)
             })
+        return True
+
+    @METRICS.timed("db_write")
+    def insert_posts(self, posts: List[PostRecord]):
+        """
+        変換済みのレスをテーブルに追加する
+        """
+        self.cursor.executemany(INSERT_POSTS, posts)
+        bbs_keys = {post.bbskey for post in posts}
+        for bbs_key in bbs_keys:
+            self.cursor.execute(UPDATE_ARCHIVED_MAX_NUMBER, {"bbskey": bbs_key})
+        METRICS.add("posts", len(posts))
+        METRICS.add("threads", len(bbs_keys))
         return self
 
-    def fetch_only_resumable(self) -> List[Tuple[str, int, str, str]]:
-        self.cursor.execute("SELECT * FROM difference")
-        return self.cursor.fetchall()
+    def mark_converted(self, bbs_key: int):
+        self.cursor.execute(MARK_CONVERTED, {"bbskey": bbs_key})
+        return self
+
+    def load_http_cache(self) -> HttpValidatorCache:
+        self.cursor.execute("SELECT url, etag, last_modified FROM http_validators")
+        return HttpValidatorCache({url: (etag, lm) for url, etag, lm in self.cursor.fetchall()})
+
+    def save_validator(self, url: str, cache: HttpValidatorCache):
+        """
+        url について新しく受け取った検証子があれば保存する
+        """
+        if (validator := cache.pop_fresh(url)) is not None:
+            self.cursor.execute(
+                """
+                INSERT INTO http_validators (url, etag, last_modified) VALUES (?, ?, ?)
+                ON CONFLICT (url)
+                DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified
+                """, (url, *validator))
+        return self
 
-    def fetch_all_available(self) -> List[Tuple[str, int, str, str]]:
-        self.cursor.execute("SELECT server, bbs, bbskey, title FROM thread_indexes")
-        return self.cursor.fetchall()
+    def load_cursor(self, source: str, query: str) -> int:
+        """
+        前回中断したインデックスの取得の、次のページを返す (無ければ 0)
+        """
+        self.cursor.execute(
+            "SELECT page FROM crawl_cursors WHERE source = ? AND query = ?", (source, query))
+        row = self.cursor.fetchone()
+        return row[0] if row else 0
+
+    def save_cursor(self, source: str, query: str, page: int):
+        self.cursor.execute(
+            """
+            INSERT INTO crawl_cursors (source, query, page, updated)
+            VALUES (?, ?, ?, datetime('now'))
+            ON CONFLICT (source, query)
+            DO UPDATE SET page = excluded.page, updated = excluded.updated
+            """, (source, query, page))
+        return self
+
+    def clear_cursor(self, source: str, query: str):
+        self.cursor.execute(
+            "DELETE FROM crawl_cursors WHERE source = ? AND query = ?", (source, query))
+        return self
+
+    def iter_chunks(self, query: str, chunk_size: int = 1000, key: int = 0) -> Iterator[tuple]:
+        """
+        query を chunk_size 行ずつ読み、一行ずつ返す (keyset pagination)
+
+        query は key 番目の列が bbskey で、「bbskey > :after ... ORDER BY bbskey LIMIT :limit」を含むこと。
+        次の chunk は前の chunk の最後の bbskey から読み直すので、
+        読んでいる間に同じ接続で書き込んでもよく、メモリには chunk_size 行しか持たない
+        """
+        after = -1
+        while rows := self.connect.execute(
+                query, {"after": after, "limit": chunk_size}).fetchall():
+            yield from rows
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][key]
+
+    def iter_only_resumable(self, chunk_size: int = 1000) -> Iterator[Tuple[str, str, int, str]]:
+        """
+        差分のビューのスレッドを (server, bbs, bbskey, title) で、chunk_size 行ずつ読んで返す
+        """
+        return self.iter_chunks(
+            """
+            SELECT * FROM difference
+            WHERE bbskey > :after ORDER BY bbskey LIMIT :limit
+            """, chunk_size, key=2)
+
+    def iter_resumable_since(
+            self, chunk_size: int = 1000) -> Iterator[Tuple[str, str, int, str, int | None]]:
+        """
+        iter_only_resumable() の各行に、アーカイブ済みの最大のレス番号を加えて返す
+        """
+        return self.iter_chunks(
+            """
+            SELECT difference.*, thread_indexes.archived_max_number
+            FROM difference INNER JOIN thread_indexes USING (bbs, bbskey)
+            WHERE bbskey > :after ORDER BY bbskey LIMIT :limit
+            """, chunk_size, key=2)
+
+    def iter_all_available(self, chunk_size: int = 1000) -> Iterator[Tuple[str, str, int, str]]:
+        """
+        すべてのスレッドを (server, bbs, bbskey, title) で、chunk_size 行ずつ読んで返す
+        """
+        return self.iter_chunks(
+            """
+            SELECT server, bbs, bbskey, title FROM thread_indexes
+            WHERE bbskey > :after ORDER BY bbskey LIMIT :limit
+            """, chunk_size, key=2)
+
+    def iter_pending_raw(self, chunk_size: int = 50) -> Iterator[Tuple[int, str, bytes | str]]:
+        """
+        変換待ちのスレッドを (bbskey, title, raw_text) で返す (raw_text は圧縮されたまま)
+
+        生の HTML は大きいので、既定では少しずつ読む
+        """
+        return self.iter_chunks(
+            """
+            SELECT bbskey, title, raw_text
+            FROM thread_raw INNER JOIN thread_indexes USING (bbskey)
+            WHERE pending = 1 AND bbskey > :after ORDER BY bbskey LIMIT :limit
+            """, chunk_size)
+
+    def count_pending(self) -> int:
+        self.cursor.execute("SELECT count(*) FROM thread_raw WHERE pending = 1")
+        return self.cursor.fetchone()[0]
+
+    def enqueue_jobs(self, threads: Iterable[tuple]):
+        """
+        ダウンロードするスレッドを作業表 (crawl_jobs) に積む
+
+        threads の各要素は (server, bbs, bbskey, title) か、末尾に差分取得の起点を加えたもの。
+        作業中 (pending / failed) のスレッドは、試行回数や待ち時間をそのままにする
+        """
+        self.cursor.executemany(
+            """
+            INSERT INTO crawl_jobs (server, bbs, bbskey, title, since)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (bbskey) DO UPDATE SET
+                title = excluded.title,
+                since = excluded.since,
+                status = 'pending',
+                attempts = 0,
+                last_error = NULL,
+                next_eligible = datetime('now'),
+                updated = datetime('now')
+            WHERE crawl_jobs.status = 'done'
+            """, ((*thread[:4], thread[4] if len(thread) > 4 else None) for thread in threads))
+        return self
+
+    def iter_jobs(self, chunk_size: int = 1000) -> Iterator[Tuple[str, str, int, str, int | None]]:
+        """
+        作業表のうち、今ダウンロードしてよいスレッドを (server, bbs, bbskey, title, since) で、
+        chunk_size 行ずつ読んで返す
+
+        読んでいる間に finish_job() や fail_job() で状態を変えてもよい
+        """
+        return self.iter_chunks(
+            """
+            SELECT server, bbs, bbskey, title, since FROM crawl_jobs
+            WHERE status != 'done' AND next_eligible <= datetime('now') AND bbskey > :after
+            ORDER BY bbskey LIMIT :limit
+            """, chunk_size, key=2)
+
+    def has_jobs(self) -> bool:
+        self.cursor.execute(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM crawl_jobs
+                WHERE status != 'done' AND next_eligible <= datetime('now'))
+            """)
+        return bool(self.cursor.fetchone()[0])
+
+    def finish_job(self, bbs_key: int):
+        self.cursor.execute(
+            "UPDATE crawl_jobs SET status = 'done', updated = datetime('now') WHERE bbskey = ?",
+            (bbs_key,))
+        return self
+
+    def fail_job(self, bbs_key: int, error: str, backoff: float, max_backoff: float = 86400):
+        """
+        失敗を記録し、backoff * 2^(試行回数 - 1) 秒 (最大 max_backoff 秒) 後まで再試行しない
+        """
+        self.cursor.execute("SELECT attempts FROM crawl_jobs WHERE bbskey = ?", (bbs_key,))
+        row = self.cursor.fetchone()
+        attempts = (row[0] if row else 0) + 1
+        delay = min(backoff * 2 ** (attempts - 1), max_backoff)
+        self.cursor.execute(
+            """
+            UPDATE crawl_jobs SET
+                status = 'failed',
+                attempts = :attempts,
+                last_error = :error,
+                next_eligible = datetime('now', :delay),
+                updated = datetime('now')
+            WHERE bbskey = :bbskey
+            """, {"attempts": attempts, "error": error, "delay": f"+{delay:.0f} seconds",
+                  "bbskey": bbs_key})
+        return self
 
 
 class Request:
     def __init__(self) -> None:
         self.headers = {}
 
-    def _update_header(self, url: str) -> None:
+    @staticmethod
+    def _header_for(url: str) -> Dict[str, str]:
         r = urlparse(url)
         host = r.netloc
-        self.headers = {"Alt-Used": host, "Host": host, "User-Agent": "Mozilla/5.0"}
+        return {"Alt-Used": host, "Host": host, "User-Agent": "Mozilla/5.0"}
+
+    def _update_header(self, url: str) -> None:
+        self.headers = self._header_for(url)
 
 
 class ThreadsIndexer:
     ENDPOINT = "https://find.5ch.net/search"
 
-    def __init__(self, query: str) -> None:
+    def __init__(self, query: str, cache: HttpValidatorCache | None = None) -> None:
         self.query = query
+        self.cache = cache
 
     def _prepare_query(self) -> Dict[str, str]:
         return {"q": self.query}
 
+    @property
+    def url(self) -> str:
+        url = requests.Request("GET", self.ENDPOINT, params=self._prepare_query()).prepare().url
+        assert url is not None
+        return url
+
     def __get(self) -> Response:
         assert self.query is not None
+        headers = self.cache.conditional_headers(self.url) if self.cache is not None else {}
         req = requests.request(
-            "GET", self.ENDPOINT, params=self._prepare_query(), timeout=10
+            "GET", self.ENDPOINT, params=self._prepare_query(), headers=headers, timeout=10
         )
+        METRICS.add("http_requests")
+        METRICS.add("http_bytes", len(req.content))
         return req
 
     def extract(self, markup: str) -> Dict[str, Any] | None:
@@ -122,11 +382,6 @@ class ThreadsIndexer:
             # return dict(zip(("bbs", "server",), (r.path[1:-1], r.netloc,)))
             return r.path[1:-1], r.netloc
 
-        def extract_datetime(s: str) -> str:
-            return datetime.strptime(s, "%Y年%m月%d日 %H:%M") \
-                .astimezone(timezone(timedelta(hours=9))) \
-                .isoformat()
-
         def extract_bbskey(s: str) -> str:
             r = urlparse(s)
             return r.path.split("/")[-1]
@@ -146,6 +401,8 @@ class ThreadsIndexer:
         def extract_is_live(n: int) -> int:
             return 0 if n > 1000 else 1
 
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(markup, "html.parser")
         r = soup.find("div", "list")
         if r is not None:
@@ -186,7 +443,7 @@ class ThreadsIndexer:
                 bbs, server = extract_serverinfo(ser)
                 r_bbs.append(bbs)
                 r_server.append(server)
-                r_updated.append(extract_datetime(date))
+                r_updated.append(index_date(date))
                 bbskey = extract_bbskey(r_url[seq])
                 r_bbskey.append(bbskey)
                 r_ikioi.append(extract_ikioi(ikioi))
@@ -211,6 +468,7 @@ class ThreadsIndexer:
                             "ikioi": ikioi,
                             "bbskey": bbskey,
                             "bbs": bbs,
+                            "created": bbskey_date(bbskey),
                             "updated": updated,
                             "id": _id,
                             "server": server,
@@ -223,129 +481,255 @@ class ThreadsIndexer:
             # pprint(a)
             return a
 
+    @METRICS.timed("index")
     def get_index(self) -> Dict[str, Any] | None:
-        markup = self.__get().text
+        """
+        検索結果が前回から変わっていない (304 Not Modified) ときは空の辞書を返す
+        """
+        response = self.__get()
+        if self.cache is not None and self.cache.record(self.url, response):
+            return {}
+        markup = response.text
         a = self.extract(markup)
         if a is not None:
             return a
 
 
 class Converter:
-    def __init__(self, bbs_key: int, markup: str | bytes) -> None:
+    def __init__(
+        self, bbs_key: int, markup: str | bytes, since: int = 0, engine: str | None = None
+    ) -> None:
         """
-        BeautifulSoupのインスタンスを作る
+        engine で指定したパーサー (modules.parsers) を用意する
+
+        since が与えられたときは、そのレス番号以下のレスを読み飛ばす
         """
-        self.threads: Posts = {}
+        self.posts: Dict[int, PostRecord] = {}
         self.bbs_key = bbs_key
-        self.soup = BeautifulSoup(markup, "html.parser")
+        self.since = since
+        self.markup = markup
+        self.parser = get_parser(engine)
 
+    @METRICS.timed("parse")
     def __elements_to_object(self):
         """
-        HTMLをパースして辞書の形に整える
+        HTMLをパースしてレス番号ごとの PostRecord にする
         """
-        post_elements = self.soup.find_all("article")
         number = name = date = uid = message = ""
         exceeded_or_ronin = 1000
 
-        for element in post_elements:
-            metas = element.find_all("details", class_="post-header")
-
-            for meta in metas:
-                number = meta.find("span", class_="postid").get_text(strip=True)
-                name = meta.find("span", class_="postusername").get_text(
-                    " ", strip=True
-                )
-                date = meta.find("span", class_="date").get_text(strip=True)
+        for meta_number, meta_name, meta_date, meta_uid, message in self.parser.iter_posts(
+            self.markup
+        ):
+            # post-header の無いレスは、直前のレスの値を引き継ぐ
+            if meta_number is not None:
+                number, name, date = meta_number, meta_name, meta_date
                 # slicing uid with "ID:"; e.g. "ID:TKRPJpAI0" -> "TKRPJpAI0"
-                uid = meta.find("span", class_="uid").get_text(strip=True)[3:]
-
-            message = element.find("section", class_="post-content").get_text(
-                "\n", strip=True
-            )
+                uid = meta_uid[3:]
 
-            if exceeded_or_ronin < int(number):
+            post_number = int(number)
+            if exceeded_or_ronin < post_number:
                 break
 
-            # あぼーん
-            if date == "NG":
-                thread_datetime = ""
-            else:
-                thread_datetime_extracted = findall(r"\d+", date)
-                assert len(thread_datetime_extracted) == 7
-                # add timezone information (Asia/Tokyo)
-                thread_datetime = (
-                    datetime.strptime(
-                        "%s/%s/%s %s:%s:%s.%s" % tuple(thread_datetime_extracted),
-                        "%Y/%m/%d %H:%M:%S.%f",
-                    )
-                    .astimezone(timezone(timedelta(hours=9)))
-                    .isoformat()
-                )
+            # 差分取得したページにも >>1 は含まれる
+            if post_number <= self.since:
+                continue
 
-            self.threads.update(
-                {
-                    int(number): {
-                        "bbskey": self.bbs_key,
-                        "number": int(number),
-                        "name": name,
-                        "date": thread_datetime,
-                        "uid": uid,
-                        "message": message,
-                    }
-                }
+            # あぼーん ("NG") の日時は空文字列になる
+            self.posts[post_number] = PostRecord(
+                self.bbs_key, post_number, name, post_date(date), uid, message
             )
 
         return self
 
+    def records(self) -> List[PostRecord]:
+        """
+        レスを番号順の PostRecord のリストで返す (ConverterDB.insert_posts() にそのまま渡せる)
+        """
+        self.__elements_to_object()
+        return list(self.posts.values())
+
     def convert(self) -> Posts:
+        """
+        レス番号をキーにした辞書で返す
+        """
         self.__elements_to_object()
-        return self.threads
+        return {number: post._asdict() for number, post in self.posts.items()}
 
     def json(self, **kwargs) -> str:
         """
         標準出力用のJSONをダンプする
         """
-        self.__elements_to_object()
-        return json.dumps(self.threads, **kwargs)
+        return json.dumps(self.convert(), **kwargs)
+
+
+def convert_markup(
+    bbs_key: int, title: str, markup: str, engine: str | None = None
+) -> Tuple[int, str, List[PostRecord]]:
+    """
+    プロセスプールのワーカーから呼ぶための、Converter の薄いラッパー
+    """
+    return bbs_key, title, Converter(bbs_key, markup, engine=engine).records()
 
 
 class ThreadsDownloader(Request):
-    def fetch_thread(self, url: str) -> str | None:
-        self._update_header(url)
+    def __init__(self, cache: HttpValidatorCache | None = None,
+                 rate: AdaptiveRateController | None = None) -> None:
+        """
+        cache を与えると、前回の ETag / Last-Modified を使って条件付きでリクエストする
+
+        rate はホストごとの間隔と再試行までの待ち時間を決める (省略したときは間隔を空けず、
+        429 / 503 や失敗のあとだけ待つ)
+        """
+        super().__init__()
+        self._session = requests.Session()
+        self.cache = cache
+        self.rate = rate or AdaptiveRateController()
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    @staticmethod
+    def thread_url(server: str, bbs: str, bbskey: int, since: int = 0) -> str:
+        """
+        since が与えられたときは、read.cgi の範囲指定で since より後のレスだけを要求する
+        """
+        if since:
+            return f"https://{server}/test/read.cgi/{bbs}/{bbskey}/{since + 1}-"
+        return f"https://{server}/test/read.cgi/{bbs}/{bbskey}/"
+
+    @METRICS.timed("http")
+    def fetch_thread(self, url: str, conditional: bool = True) -> str:
+        """
+        本文を少しずつ受け取って decode し、meta タグの charset を UTF-8 に書き換えて返す
+
+        変更がなかった (304 Not Modified) ときは NOT_MODIFIED を返す。
+        dat 落ち ("Gone.") は見つけた時点で読むのをやめ、BadContentError を送出する
+        """
+        headers = self._header_for(url)
+        if conditional and self.cache is not None:
+            headers.update(self.cache.conditional_headers(url))
+        response = self.session.get(url, headers=headers, timeout=10, stream=True)
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            METRICS.add("http_requests")
+            if response.status_code in THROTTLE_STATUSES:
+                raise ThrottledError(
+                    f"{response.status_code} {response.reason}",
+                    parse_retry_after(response.headers.get("Retry-After")))
             response.raise_for_status()
-            if "Gone.\n" in response.text:
-                raise BadContentError("found 'Gone.' in the response")
-        except requests.exceptions.HTTPError:
+            if conditional and self.cache is not None and self.cache.record(url, response):
+                return NOT_MODIFIED
+            return decode_thread(
+                counted(response.iter_content(CHUNK_SIZE)),
+                response_encoding(response.headers.get("Content-Type")))
+        except requests.exceptions.HTTPError as e:
             logging.exception("HTTP error occured")
-            return None
-        return response.text
+            raise DownloadError(str(e)) from e
+        finally:
+            # 途中でやめたときは接続ごと捨てる (読み切ったときは使い回される)
+            response.close()
 
-    def __fetch_thread_try(self, url: str) -> str | None:
+    def _fetch_thread_try(self, url: str, conditional: bool = True) -> str:
         """
-        スレッドが返ってくるまでダウンロードを試行
+        スレッドが返ってくるまでダウンロードを試行し、max_retry 回失敗したら DownloadError を送出する
+
+        dat 落ち (BadContentError) は再試行せず、すぐに DownloadError を送出する
         """
+        host = urlparse(url).netloc
+        error: Exception | None = None
         for _ in range(args.max_retry):
+            # 再試行の前には、rate が決めた時間だけ待つ
+            self.rate.acquire(host)
+            start, outcome, retry_after = monotonic(), OK, None
             try:
-                r = self.fetch_thread(url)
-                return r
-            except requests.exceptions.Timeout:
+                return self.fetch_thread(url, conditional)
+            except ThrottledError as e:
+                logging.warning("throttled by %s (%s), backing off", host, e)
+                outcome, retry_after, error = THROTTLED, e.retry_after, e
+            except requests.exceptions.RequestException as e:
+                # 接続の失敗や、本文を読んでいる途中で切れた (ChunkedEncodingError) ときなど。
+                # HTTPError は fetch_thread() が DownloadError にしてある
                 logging.exception("error may be occured due to connectivity")
-            except BadContentError:
-                logging.exception("retrying...")
-        sys.exit(1)
+                outcome, error = FAILED, e
+            except BadContentError as e:
+                # dat 落ちはサーバーが混んでいるわけではないので、間隔を変えず、再試行もしない
+                logging.warning("bad content from %s: %s", url, e)
+                outcome = NEUTRAL
+                raise DownloadError(f"bad content: {e}") from e
+            finally:
+                # 404 などの DownloadError は、サーバーが混んでいるわけではないので OK として扱う
+                self.rate.release(host, monotonic() - start, outcome, retry_after)
+        raise DownloadError(f"gave up after {args.max_retry} tries: {error!r}")
+
+    def generate_response(self, threads: list):
+        """
+        条件に応じて、_fetch_thread_try() を回す
+
+        threads の各要素は (server, bbs, bbskey, title) か、
+        差分取得のときは末尾に取得済みの最大のレス番号を加えたもの
+        """
+        for thread in threads:
+            yield self._fetch_one(*thread)
+
+    def _fetch_one(self, server: str, bbs: str, bbskey: int, title: str, since: int | None = 0):
+        # 差分取得の URL は毎回変わるので、条件付きリクエストにしない
+        url = self.thread_url(server, bbs, bbskey, since or 0)
+        try:
+            thread = self._fetch_thread_try(url, conditional=not since)
+        except DownloadError as e:
+            # 一つのスレッドの失敗で全体を止めず、呼び出し側に作業表へ記録させる
+            return (bbskey, title, e, url)
+        return self._as_response(bbskey, title, thread, url)
+
+    @staticmethod
+    def _as_response(bbskey: int, title: str, thread: str | None, url: str):
+        """
+        (bbskey, title, text, url) を返す
+
+        変更がなかったときの text は NOT_MODIFIED に、失敗したときや本文が空のときは DownloadError になる
+        """
+        if thread == NOT_MODIFIED:
+            return (bbskey, title, NOT_MODIFIED, url)
+        if not thread:
+            # 他の失敗と同じく、呼び出し側に作業表で後回しにさせる
+            return (bbskey, title, DownloadError("empty response"), url)
+        # meta タグの "Shift_JIS" は、fetch_thread() が "UTF-8" に書き換えてある
+        return (bbskey, title, thread, url)
+
+
+class ConcurrentThreadsDownloader(ThreadsDownloader):
+    def __init__(
+        self, jobs: int, interval: float, cache: HttpValidatorCache | None = None,
+        rate: AdaptiveRateController | None = None,
+    ) -> None:
+        """
+        複数のスレッドを並行してダウンロードする
+
+        接続はワーカーごとのセッションで使い回し、間隔はサーバーのホストごとに空ける。
+        rate を省略したときは、間隔を interval 秒に保つ
+        """
+        super().__init__(
+            cache, rate or AdaptiveRateController(interval, concurrency=jobs))
+        self.jobs = jobs
+        self.__local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        # requests.Session はスレッドセーフではないので、ワーカーごとに持つ
+        if (session := getattr(self.__local, "session", None)) is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.jobs)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.__local.session = session
+        return session
 
     def generate_response(self, threads: list):
         """
-        条件に応じて、__fetch_thread() を回す
-        """
-        for server, bbs, bbskey, title in threads:
-            fetch_url = f"https://{server}/test/read.cgi/{bbs}/{bbskey}/"
-            thread = self.__fetch_thread_try(fetch_url)
-            if thread:
-                # Replace "Shift_JIS" with "UTF-8" in meta tag
-                text = thread.replace("charset=Shift_JIS", 'charset="UTF-8"')
-                yield (bbskey, title, text)
-            else:
-                yield None
+        ワーカーに _fetch_one() を回させ、結果を元の順番で返す
+
+        間隔は rate がホストごとに空ける。先読みは jobs の 2 倍までに抑える
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            yield from bounded_map(executor, self._fetch_one, threads, self.jobs * 2)
@@ -0,0 +1,181 @@
+"""
+複数の検索クエリと取得元 (find.5ch.net、過去ログ) から、スレッドの目次をまとめて集める
+
+(取得元, クエリ) の組ごとにスレッドで並行に取得し、間隔は取得元ごとに空ける。
+取得した目次は、find.5ch.net は検索結果ごと、過去ログはページごとにメインスレッドへ渡すので、
+中断しても書き込んだページまでは残る。
+同じスレッドは (bbs, bbskey) でまとめ、内容が変わらないものは書き込まない。
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Tuple
+import requests
+from modules.classes import ThreadsIndexer
+from modules.httpcache import HttpValidatorCache
+from modules.kakolog import KakologThreadsIndexer
+from modules.metrics import METRICS
+from modules.ratecontrol import AdaptiveRateController
+from modules.types import Thread
+
+SOURCES = ("find", "kakolog")
+DEFAULT_QUERY = "なんJNVA部"
+
+
+class IndexBatch(NamedTuple):
+    """
+    IndexCollector.iter_batches() が返す、一度に書き込む目次
+    """
+    source: str
+    query: str
+    # 過去ログの、このページの次のページ (find.5ch.net では None)
+    next_page: int | None
+    # 新しいスレッドか、前に返したものから変わったスレッドだけ
+    threads: List[Thread]
+
+
+def merge(current: Thread, new: Thread) -> Thread:
+    """
+    同じスレッドの目次を一つにする
+
+    レス数の多い (新しい) 方を優先し、足りない項目はもう一方で埋める。
+    同じなら先に取得した方を残す
+    """
+    if int(new.get("resnum") or 0) > int(current.get("resnum") or 0):
+        return {**current, **new}
+    return {**new, **current}
+
+
+class IndexCollector:
+    def __init__(
+        self,
+        queries: Iterable[str],
+        sources: Iterable[str] = ("find",),
+        cache: HttpValidatorCache | None = None,
+        interval: float = 1,
+        jobs: int | None = None,
+    ) -> None:
+        """
+        interval は取得元ごとのリクエストの間隔 (秒)、jobs は同時に取得する (取得元, クエリ) の数
+
+        jobs を省略したときは、すべての組を同時に取得する (間隔は取得元ごとに守られる)
+        """
+        self.queries: List[str] = list(dict.fromkeys(queries))
+        self.sources: List[str] = [s for s in SOURCES if s in set(sources)]
+        self.cache = cache
+        self.jobs = max(jobs or len(self.sources) * len(self.queries), 1)
+        self.find_rate = AdaptiveRateController(interval, concurrency=self.jobs)
+        # 過去ログの API は 429 / 503 の Retry-After や失敗のあとの待ち時間も守る
+        self.kakolog_rate = AdaptiveRateController(interval)
+        # 過去ログのクエリごとの (次のページ, 最後まで取得したか)
+        self.cursors: Dict[str, Tuple[int, bool]] = {}
+        # 取得できた find.5ch.net の検索結果の URL (条件付きリクエストの検証子を保存する)
+        self.urls: List[str] = []
+        # 取得に失敗した (取得元, クエリ)
+        self.failures: List[Tuple[str, str]] = []
+        self.fetched = 0
+        # iter_batches() が返したスレッドの数 (重複を除いたあとの書き込む行数)
+        self.written = 0
+        self.__seen: Dict[Tuple[str, int], Thread] = {}
+        self.__stop = threading.Event()
+
+    def __find(self, query: str, batches: "queue.Queue[IndexBatch | None]") -> None:
+        indexer = ThreadsIndexer(query, self.cache)
+        self.find_rate.acquire("find")
+        start = monotonic()
+        try:
+            index = indexer.get_index()
+        except requests.exceptions.RequestException:
+            # 取得元に繋がらなくても、他の取得元とスレッドのダウンロードは続ける
+            logging.exception("インデックスの取得中にエラーが発生しました: %s", query)
+            index = None
+        finally:
+            self.find_rate.release("find", monotonic() - start)
+        if index is None:
+            logging.warning("インデックスを取得できませんでした: %s", query)
+            self.failures.append(("find", query))
+            return
+        self.urls.append(indexer.url)
+        batches.put(IndexBatch("find", query, None, list(index.values())))
+
+    def __kakolog(self, query: str, start: int,
+                  batches: "queue.Queue[IndexBatch | None]") -> None:
+        """
+        過去ログの API を start ページから最後まで取得する
+
+        ページの順番は前のページを取得しないと決まらないので、クエリの中では順に取得する
+        """
+        indexer = KakologThreadsIndexer(query, self.kakolog_rate)
+        logging.info("過去ログのインデックスを %d ページ目から取得します: %s", start, query)
+        page = start - 1
+        try:
+            # 間隔は kakolog_rate がクエリをまたいで空ける
+            for page, chunk in indexer.iter_pages(start, interval=0):
+                batches.put(IndexBatch("kakolog", query, page + 1, list(chunk.values())))
+                if self.__stop.is_set():
+                    return
+        except (requests.exceptions.RequestException, ValueError):
+            # 繋がらないときや、壊れた JSON が返ってきたとき (続きは次回このページから取り直す)
+            logging.exception("過去ログのインデックスの取得中にエラーが発生しました: %s", query)
+        if not indexer.exhausted:
+            self.failures.append(("kakolog", query))
+        self.cursors[query] = (page + 1, indexer.exhausted)
+
+    def __dedupe(self, batch: IndexBatch) -> IndexBatch:
+        """
+        batch のうち、新しいスレッドと、前に返したものから変わったスレッドだけを残す
+        """
+        threads: List[Thread] = []
+        for thread in batch.threads:
+            self.fetched += 1
+            key = (str(thread["bbs"]), int(thread["bbskey"]))
+            if (current := self.__seen.get(key)) is not None:
+                if (thread := merge(current, thread)) == current:
+                    continue
+            self.__seen[key] = thread
+            threads.append(thread)
+        self.written += len(threads)
+        threads.sort(key=lambda t: (int(t["bbskey"]), str(t["bbs"])))
+        return batch._replace(threads=threads)
+
+    def iter_batches(self, starts: Dict[str, int] | None = None) -> Iterator[IndexBatch]:
+        """
+        すべての (取得元, クエリ) の目次を取得し、取得できたものから IndexBatch で返す
+
+        starts は過去ログのクエリごとの開始ページ。一つの IndexCollector では一度だけ呼ぶ。
+        途中で読むのをやめたり (close())、Ctrl-C で中断したりしたときは、
+        取得中のワーカーを待たずに止める
+        """
+        starts = starts or {}
+        batches: "queue.Queue[IndexBatch | None]" = queue.Queue()
+        self.__stop.clear()
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        futures = [
+            executor.submit(self.__find, query, batches) if source == "find"
+            else executor.submit(self.__kakolog, query, starts.get(query, 0), batches)
+            for source in self.sources for query in self.queries
+        ]
+        # ワーカーが終わるたびに None を送り、すべて終わったことを知らせる
+        for future in futures:
+            future.add_done_callback(lambda _: batches.put(None))
+        try:
+            remaining = len(futures)
+            while remaining:
+                if (batch := batches.get()) is None:
+                    remaining -= 1
+                else:
+                    # 重複を除いて空になっても、過去ログの次のページの位置は書き込む
+                    yield self.__dedupe(batch)
+            for future in futures:
+                future.result()
+        finally:
+            self.__stop.set()
+            self.find_rate.cancel()
+            self.kakolog_rate.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+        METRICS.add("index_entries", self.fetched)
+        logging.info(
+            "%d 件の目次を取得し、重複を除いて %d 件を書き込みました (クエリ %d 個、取得元 %s)",
+            self.fetched, self.written, len(self.queries), ", ".join(self.sources))
@@ -0,0 +1,114 @@
+"""
+thread_raw.raw_text の圧縮と展開
+
+圧縮したものは BLOB として保存し、先頭 5 バイトに形式を書いておく
+- 1 バイト目: 圧縮方式 (b"z": zlib, b"s": zstd)
+- 2-5 バイト目: 辞書の id (ビッグエンディアン、0 は辞書なし)
+TEXT のままの行 (圧縮前の行やインデックスだけの行) はそのまま返す
+"""
+import hashlib
+import sqlite3
+import zlib
+from types import ModuleType
+from typing import Dict, Iterable, List
+
+CODECS = ("none", "zlib", "zstd")
+DEFAULT_CODEC = "zlib"
+
+_TAGS = {"zlib": b"z", "zstd": b"s"}
+_NAMES = {v: k for k, v in _TAGS.items()}
+# zlib の辞書は 32KiB まで
+ZLIB_DICT_SIZE = 32 * 1024
+
+
+def _zstandard() -> ModuleType:
+    """
+    zstandard は、zstd を使うときになってから import する
+    """
+    try:
+        import zstandard
+    except ImportError as e:  # pragma: no cover
+        raise RuntimeError("zstandard がインストールされていません") from e
+    return zstandard
+
+
+class RawTextCodec:
+    def __init__(self, codec: str = DEFAULT_CODEC,
+                 dictionaries: Dict[int, bytes] | None = None, dict_id: int = 0) -> None:
+        """
+        codec で圧縮する
+
+        dictionaries ({id: 辞書}) は展開に使い、圧縮には dict_id の辞書を使う
+        """
+        if codec == "zstd":
+            _zstandard()
+        self.codec = codec
+        self.dictionaries = dictionaries or {}
+        self.dict_id = dict_id
+
+    @classmethod
+    def from_connection(cls, conn: sqlite3.Connection, codec: str = DEFAULT_CODEC):
+        """
+        テーブル raw_text_dictionaries に登録された辞書を読み込み、
+        codec 用の最も新しい辞書で圧縮するようにする
+        """
+        try:
+            rows = conn.execute("SELECT id, codec, data FROM raw_text_dictionaries").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        dict_id = max((i for i, c, _ in rows if c == codec), default=0)
+        return cls(codec, {i: data for i, _, data in rows}, dict_id)
+
+    def encode(self, text: str) -> str | bytes:
+        if self.codec == "none" or not text:
+            return text
+        data = text.encode("utf-8")
+        zdict = self.dictionaries.get(self.dict_id)
+        if self.codec == "zstd":
+            zstandard = _zstandard()
+            params = {"dict_data": zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+            payload = zstandard.ZstdCompressor(level=10, **params).compress(data)
+        else:
+            c = zlib.compressobj(9, zdict=zdict) if zdict else zlib.compressobj(9)
+            payload = c.compress(data) + c.flush()
+        return _TAGS[self.codec] + self.dict_id.to_bytes(4, "big") + payload
+
+    def decode(self, value: str | bytes) -> str:
+        if isinstance(value, str):
+            return value
+        codec, dict_id, payload = _NAMES[value[:1]], int.from_bytes(value[1:5], "big"), value[5:]
+        zdict = self.dictionaries[dict_id] if dict_id else None
+        if codec == "zstd":
+            zstandard = _zstandard()
+            params = {"dict_data": zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+            data = zstandard.ZstdDecompressor(**params).decompress(payload)
+        else:
+            d = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+            data = d.decompress(payload) + d.flush()
+        return data.decode("utf-8")
+
+
+def markup_digest(markup: str) -> str:
+    """
+    生の HTML の内容のハッシュ値 (圧縮方式によらない)
+
+    広告などレスの外側は取得のたびに変わるので、最初の <article から最後の </article> までを使う
+    (article が無いページは全体を使う)
+    """
+    start, end = markup.find("<article"), markup.rfind("</article>")
+    if start != -1 and end != -1:
+        markup = markup[start:end + len("</article>")]
+    return hashlib.sha256(markup.encode("utf-8")).hexdigest()
+
+
+def train_dictionary(codec: str, samples: Iterable[str], size: int = 112640) -> bytes:
+    """
+    スレッドの HTML のサンプルから、圧縮用の辞書を作る
+
+    zlib は辞書の後ろほど参照されやすいので、サンプルの末尾を詰めたものを使う
+    """
+    data: List[bytes] = [s.encode("utf-8") for s in samples if s]
+    if codec == "zstd":
+        return _zstandard().train_dictionary(size, data).as_bytes()
+    per_sample = max(ZLIB_DICT_SIZE // max(len(data), 1), 1024)
+    return b"".join(d[-per_sample:] for d in data)[-ZLIB_DICT_SIZE:]
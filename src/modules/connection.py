@@ -0,0 +1,70 @@
+"""
+SQLite への接続をまとめて作る
+
+WAL にしておくと、クロール中でも search.py や export.py が読み出せる
+(書き込みと読み出しが互いを待たない)。
+"""
+import sqlite3
+from time import monotonic
+from typing import Any, Callable
+
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL")
+# 書き込みが重なったときに待つ時間 (ミリ秒)
+BUSY_TIMEOUT = 30000
+
+
+def connect(path: str, synchronous: str = "NORMAL", cache_mib: int = 64, mmap_mib: int = 256,
+            readonly: bool = False, **kwargs: Any) -> sqlite3.Connection:
+    """
+    pragma を設定した接続を返す
+
+    WAL では synchronous = NORMAL でもデータベースは壊れない
+    (電源断のときに、最後のいくつかのコミットが失われることはある)。
+    readonly のときはジャーナルの設定を変えず、読み出し専用で開く
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, **kwargs)
+    else:
+        conn = sqlite3.connect(path, **kwargs)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS[SYNCHRONOUS.index(synchronous)]}")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+    # 負の値は KiB 単位
+    conn.execute(f"PRAGMA cache_size = {-int(cache_mib) * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_mib) * 2**20}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+class GroupCommit:
+    def __init__(self, commit: Callable[[], Any], every: int = 1, interval: float = 0) -> None:
+        """
+        tick() が every 回呼ばれるか、前回のコミットから interval 秒経つごとに commit() を呼ぶ
+
+        interval が 0 のときは回数だけで決める
+        """
+        self.commit = commit
+        self.every = max(every, 1)
+        self.interval = interval
+        self.pending = 0
+        self.commits = 0
+        self.__last = monotonic()
+
+    def tick(self) -> bool:
+        """
+        コミットしたかどうかを返す
+        """
+        self.pending += 1
+        if self.pending >= self.every or (
+            self.interval and monotonic() - self.__last >= self.interval
+        ):
+            self.flush()
+            return True
+        return False
+
+    def flush(self) -> None:
+        if self.pending:
+            self.commit()
+            self.commits += 1
+        self.pending = 0
+        self.__last = monotonic()
@@ -0,0 +1,105 @@
+"""
+ベンチマーク用の、5ch と過去ログの検索を模したデータ
+
+- read.cgi のスレッドのページ (thread_page)
+- find.5ch.net の検索結果のページ (search_page)
+- kakolog.jp の API の JSON (kakolog_page)
+
+どれも同じ引数からは同じものを作るので、版ごとの計測結果を比べられる。
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+BBS = "liveuranus"
+FIRST_BBSKEY = 1600000000
+
+
+def thread_page(posts: int, charset: str = '"UTF-8"', bbskey: int = 1) -> str:
+    """
+    read.cgi のスレッドのページを模した HTML を作る
+
+    あぼーん、ID の無い名前欄、script や実体参照を含む本文も混ぜておく
+    """
+    articles = []
+    for i in range(1, posts + 1):
+        date = "NG" if i % 97 == 0 else (
+            f"2023/06/{i % 28 + 1:02d}(金) {i % 24:02d}:{i % 60:02d}:{i * 7 % 60:02d}.{i % 100:02d}"
+        )
+        articles.append(
+            f'<article id="{i}" class="clear post">'
+            '<details open class="post-header"><summary>'
+            f'<span class="postid">{i}</span>'
+            '<span class="postusername"><b>名無しさん</b>@<a href="#">ｵｰﾊﾞｰｸﾛｯｸ</a>　</span>'
+            f'<span class="date">{date}</span><span class="uid">ID:aBcD{i:05d}</span>'
+            "</summary></details>"
+            f'<section class="post-content"> <a href="../test/read.cgi/{BBS}/{bbskey}/{i - 1}">'
+            f"&gt;&gt;{max(i - 1, 1)}</a><br> 本文 &amp; {i}<!-- c --> <br>"
+            "<script>void(0)</script>二行目　</section></article>"
+        )
+    return (
+        f'<html><head><meta http-equiv="Content-Type" content="text/html; charset={charset}">'
+        "<title>なんJNVA部</title></head><body><div class=\"thread\">"
+        + "".join(articles)
+        + "</div></body></html>"
+    )
+
+
+def threads(server: str, count: int, live: int = 0) -> List[Dict[str, int | str]]:
+    """
+    server にある count 個のスレッドの目次 (新しい live 個は実況中) を作る
+    """
+    base = datetime(2023, 6, 19, 12, 0, tzinfo=timezone(timedelta(hours=9)))
+    entries = []
+    for i in range(count):
+        is_live = int(i >= count - live)
+        entries.append({
+            "server": server,
+            "bbs": BBS,
+            "bbskey": FIRST_BBSKEY + i,
+            "title": f"なんJNVA部★{i + 1}",
+            "resnum": 500 if is_live else 1002,
+            "created": (base + timedelta(hours=i)).isoformat(),
+            "updated": (base + timedelta(hours=i + 6)).isoformat(),
+            "is_live": is_live,
+        })
+    return entries
+
+
+def search_page(entries: List[Dict[str, int | str]]) -> str:
+    """
+    find.5ch.net の検索結果のページを模した HTML を作る (ThreadsIndexer.extract が読む部分)
+    """
+    lines = []
+    for e in entries:
+        updated = datetime.fromisoformat(str(e["updated"])).strftime("%Y年%m月%d日 %H:%M")
+        lines.append(
+            '<div class="list_line">'
+            f'<a class="list_line_link" '
+            f'href="https://{e["server"]}/test/read.cgi/{e["bbs"]}/{e["bbskey"]}">'
+            f'<div class="list_line_link_title">{e["title"]} ({e["resnum"]})</div></a>'
+            '<div class="list_line_info">'
+            f'<div class="list_line_info_container"><a href="https://{e["server"]}/{e["bbs"]}/">'
+            "なんでも実況U</a></div>"
+            f'<div class="list_line_info_container">{updated}</div>'
+            f'<div class="list_line_info_container">{e["bbskey"] % 1000 / 10:.1f}/日</div>'
+            "</div></div>"
+        )
+    return (
+        "<html><head><title>find.5ch.net</title></head><body>"
+        '<div class="list">' + "".join(lines) + "</div></body></html>"
+    )
+
+
+def kakolog_page(entries: List[Dict[str, int | str]], page: int, per_page: int = 50) -> str:
+    """
+    kakolog.jp の API の page ページ目の JSON を作る (最後のページの次は空の list)
+    """
+    chunk = entries[page * per_page:(page + 1) * per_page]
+    return json.dumps({
+        "list": [
+            # API のタイトルには末尾に空白が付いている
+            dict(e, title=f'{e["title"]} ') for e in chunk
+        ],
+        "page": page,
+    }, ensure_ascii=False)
@@ -4,3 +4,12 @@ class BadContentError(Exception):
 
 class DownloadError(Exception):
     pass
+
+
+class ThrottledError(Exception):
+    """
+    429 / 503 が返ってきたとき (retry_after は Retry-After の秒数)
+    """
+    def __init__(self, message: str, retry_after: float | None = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,63 @@
+"""
+ETag / Last-Modified を使った条件付きリクエストのための検証子のキャッシュ
+
+データベースへの読み書きは ConverterDB が行い、ここではメモリ上で扱う。
+ダウンロードはワーカーのスレッドから行うので、ロックで守る。
+"""
+import threading
+from typing import Dict, Tuple
+
+import requests
+
+# (ETag, Last-Modified)
+Validator = Tuple[str | None, str | None]
+
+# 304 Not Modified が返ってきたときに、本文の代わりに返す
+NOT_MODIFIED = "\x00not-modified"
+
+
+class HttpValidatorCache:
+    def __init__(self, validators: Dict[str, Validator] | None = None) -> None:
+        self.validators = validators or {}
+        # 今回の実行で新しく受け取った検証子 (保存されるまで持っておく)
+        self.fresh: Dict[str, Validator] = {}
+        self.requests = 0
+        self.hits = 0
+        self.__lock = threading.Lock()
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        with self.__lock:
+            etag, last_modified = self.validators.get(url, (None, None))
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def record(self, url: str, response: requests.Response) -> bool:
+        """
+        レスポンスを記録し、304 Not Modified だったかどうかを返す
+        """
+        with self.__lock:
+            self.requests += 1
+            if response.status_code == 304:
+                self.hits += 1
+                return True
+            validator = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            if any(validator):
+                self.fresh[url] = validator
+            return False
+
+    def pop_fresh(self, url: str) -> Validator | None:
+        """
+        url の新しい検証子を取り出す (本文と一緒に保存するときに使う)
+        """
+        with self.__lock:
+            if (validator := self.fresh.pop(url, None)) is not None:
+                self.validators[url] = validator
+            return validator
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / self.requests if self.requests else 0.0
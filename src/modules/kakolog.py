@@ -3,29 +3,62 @@ import itertools
 import json
 import logging
 import sys
-from time import sleep
+from time import monotonic, sleep
 from types import SimpleNamespace
+from typing import Iterator, Tuple
+from urllib.parse import urlparse
 import requests
 from modules.classes import Request
+from modules.ratecontrol import (
+    FAILED,
+    OK,
+    THROTTLED,
+    THROTTLE_STATUSES,
+    AdaptiveRateController,
+    parse_retry_after,
+)
 from modules.types import Response, Threads
 
 
 class KakologThreadsRequest(Request):
     ENDPOINT = "https://kakolog.jp/ajax/ajax_search.v16.cgi"
+    # 429 / 503 や接続の失敗のときに、同じページを取り直す回数
+    MAX_RETRY = 3
 
-    def __init__(self, query: str) -> None:
+    def __init__(self, query: str, rate: AdaptiveRateController | None = None) -> None:
+        """
+        rate を省略したときは間隔を空けない (429 / 503 や失敗のあとだけ待つ)
+        """
         super().__init__()
         self.response_text: str = ""
         self.search_query: str = query
+        self.rate = rate or AdaptiveRateController()
 
     def __get(self, **kwargs) -> Response | None:
-        try:
-            r = requests.get(**kwargs)
-            r.raise_for_status()
-        except requests.exceptions.HTTPError:
-            logging.exception("ページの取得中にエラーが発生しました")
-            return None
-        return r
+        host = urlparse(kwargs["url"]).netloc
+        for _ in range(self.MAX_RETRY):
+            self.rate.acquire(host)
+            start, outcome, retry_after = monotonic(), OK, None
+            try:
+                r = requests.get(**kwargs)
+                if r.status_code in THROTTLE_STATUSES:
+                    logging.warning("throttled by %s (%d), backing off", host, r.status_code)
+                    outcome = THROTTLED
+                    retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                    continue
+                r.raise_for_status()
+            except requests.exceptions.HTTPError:
+                logging.exception("ページの取得中にエラーが発生しました")
+                return None
+            except requests.exceptions.RequestException:
+                # 接続の失敗や、本文を読んでいる途中で切れたときなど
+                logging.exception("ページの取得中にエラーが発生しました")
+                outcome = FAILED
+                continue
+            finally:
+                self.rate.release(host, monotonic() - start, outcome, retry_after)
+            return r
+        return None
 
     def set_response(self, s):
         self.response_text = s
@@ -42,6 +75,8 @@ class KakologThreadsRequest(Request):
         self._update_header(self.ENDPOINT)
         logging.debug("http header updated: %s", self.headers)
         logging.debug(q)
+        # 失敗したときに前のページの内容を返さないようにする
+        self.set_response(None)
         self.get(url=self.ENDPOINT, headers={}, params=q, timeout=5)
         if self.response_text is not None:
             return self.response_text
@@ -49,9 +84,12 @@ class KakologThreadsRequest(Request):
 
 
 class KakologThreadsIndexer:
-    def __init__(self, query) -> None:
+    def __init__(self, query, rate: AdaptiveRateController | None = None) -> None:
         self.__threads: Threads = {}
         self.search_query: str = query
+        self.rate = rate
+        # 最後のページまで取得できたかどうか
+        self.exhausted = False
 
     def extract_status(self, a: list):
         """抽出されたスレの目次のデータを辞書に格納する"""
@@ -66,31 +104,41 @@ class KakologThreadsIndexer:
     def append_threads(self, x):
         self.__threads.update(x)
 
+    def iter_pages(self, start: int = 0, interval: float = 1) -> Iterator[Tuple[int, Threads]]:
+        """
+        過去ログの API のページを start から順に取得し、(ページ番号, 目次) を返す
+
+        最後のページに着いたら exhausted を立てて終わる。
+        取得に失敗したときは exhausted を立てずに終わるので、続きは同じページから取り直す。
+        interval が 0 のときは待たない (呼び出し側で間隔を空ける)
+        """
+        rq = KakologThreadsRequest(self.search_query, self.rate)
+        for page in itertools.count(start):
+            r = rq.request_page_of(page)
+            if r is None:
+                return
+            j = json.loads(r)
+            # 'list': 各スレの見出しのデータで、最後のページで空になる
+            if not (lst := j.get("list")):
+                logging.info("the last page reached")
+                self.exhausted = True
+                return
+            logging.info(
+                "successfully downloaded indices of threads (on page %d)", page
+            )
+            yield page, self.extract_status(lst)
+            if interval:
+                sleep(interval)
+
     def __request_api_many(self):
         """過去ログの API のURLに向かって繰り返しリクエストする"""
-        rq = KakologThreadsRequest(self.search_query)
-        for page in itertools.count():
-            r = rq.request_page_of(page)
-            if r is not None:
-                j = json.loads(r)
-                # 'list': 各スレの見出しのデータで、最後のページで空になる
-                if not (lst := j.get("list")):
-                    logging.info("the last page reached")
-                    break
-                logging.info(
-                    "successfully downloaded indices of threads (on page %d)", page
-                )
-
-                if lst is not None:
-                    chunk = self.extract_status(lst)
-                    self.append_threads(chunk)
-                sleep(1)
-            else:
-                # 例外処理
-                if len(self.__threads) < 1:
-                    sys.exit(1)
-                # 一つでも取得したスレッドがあるなら次の処理へ
-                break
+        for _, chunk in self.iter_pages():
+            self.append_threads(chunk)
+
+        # 例外処理
+        if not self.exhausted and len(self.__threads) < 1:
+            sys.exit(1)
+        # 一つでも取得したスレッドがあるなら次の処理へ
         return self
 
     def out(self):
@@ -0,0 +1,169 @@
+"""
+処理の段階ごとの所要時間と、件数やバイト数を集計する
+
+常に有効にしておけるよう、一回の記録は perf_counter() 二回とロック一回で済ませる。
+実行の終わりに JSON か Prometheus のテキスト形式で書き出す。
+"""
+import json
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+from typing import Any, Dict, Iterator, List
+
+# 秒 (Prometheus のヒストグラムの le)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self) -> None:
+        # 最後は +Inf
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """
+        q 分位点を含むバケットの上限 (+Inf のバケットなら最大値) を返す
+        """
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        cumulative, seen = {}, 0
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            seen += count
+            cumulative[str(bound)] = seen
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": cumulative,
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        # 名前ごとの、ホストなどのラベルごとの最後の値
+        self.gauges: Dict[str, Dict[str, float]] = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self.__lock:
+            if (histogram := self.stages.get(stage)) is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def add(self, counter: str, value: float = 1) -> None:
+        with self.__lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def gauge(self, name: str, value: float, label: str = "") -> None:
+        with self.__lock:
+            self.gauges.setdefault(name, {})[label] = value
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    def timed(self, stage: str):
+        """
+        関数の呼び出しにかかった時間を stage に記録するデコレーター
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(stage, perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = perf_counter() - self.started
+        with self.__lock:
+            return {
+                "elapsed_sec": elapsed,
+                "stages": {name: h.summary() for name, h in sorted(self.stages.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": {name: dict(sorted(values.items()))
+                           for name, values in sorted(self.gauges.items())},
+                "per_sec": {
+                    name: value / elapsed if elapsed else 0.0
+                    for name, value in sorted(self.counters.items())
+                },
+            }
+
+    def prometheus(self) -> str:
+        summary = self.summary()
+        lines = [
+            "# TYPE jnva_stage_seconds histogram",
+        ]
+        for name, stage in summary["stages"].items():
+            for bound, count in stage["buckets"].items():
+                lines.append(f'jnva_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'jnva_stage_seconds_sum{{stage="{name}"}} {stage["sum"]}')
+            lines.append(f'jnva_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        for name, value in summary["counters"].items():
+            lines.append(f"# TYPE jnva_{name}_total counter")
+            lines.append(f"jnva_{name}_total {value}")
+        for name, values in summary["gauges"].items():
+            lines.append(f"# TYPE jnva_{name} gauge")
+            for label, value in values.items():
+                lines.append(f'jnva_{name}{{host="{label}"}} {value}')
+        lines.append("# TYPE jnva_elapsed_seconds gauge")
+        lines.append(f"jnva_elapsed_seconds {summary['elapsed_sec']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        拡張子が .prom なら Prometheus のテキスト形式で、それ以外は JSON で書き出す
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2)
+
+    def report(self) -> str:
+        """
+        ログ用の一行の要約
+        """
+        summary = self.summary()
+        stages = ", ".join(
+            f"{name} {s['sum']:.1f}s/{s['count']}" for name, s in summary["stages"].items())
+        counters = ", ".join(
+            f"{name} {value:.0f} ({summary['per_sec'][name]:.1f}/s)"
+            for name, value in summary["counters"].items())
+        return f"{summary['elapsed_sec']:.1f}s total; {stages}; {counters}"
+
+
+# プロセス全体で一つ
+METRICS = Metrics()
@@ -0,0 +1,115 @@
+"""
+スレッドの HTML からレスを取り出すパーサー
+
+どのエンジンも、レスごとに (number, name, date, uid, message) を順に返す。
+number, name, date, uid は post-header が無いレスでは None になる。
+"""
+from importlib.util import find_spec
+from io import BytesIO
+from typing import Iterator, Optional, Tuple
+
+# bs4 と lxml は import に時間がかかるので、実際にパースするときに読み込む
+HAS_LXML = find_spec("lxml") is not None
+
+RawPost = Tuple[Optional[str], Optional[str], Optional[str], Optional[str], str]
+
+
+class BeautifulSoupParser:
+    """
+    BeautifulSoup (html.parser) で木全体を作ってから辿る、基準となる実装
+    """
+
+    name = "bs4"
+
+    def iter_posts(self, markup: str | bytes) -> Iterator[RawPost]:
+        from bs4 import BeautifulSoup
+
+        soup = BeautifulSoup(markup, "html.parser")
+
+        for element in soup.find_all("article"):
+            number = name = date = uid = None
+            for meta in element.find_all("details", class_="post-header"):
+                number = meta.find("span", class_="postid").get_text(strip=True)
+                name = meta.find("span", class_="postusername").get_text(" ", strip=True)
+                date = meta.find("span", class_="date").get_text(strip=True)
+                uid = meta.find("span", class_="uid").get_text(strip=True)
+
+            message = element.find("section", class_="post-content").get_text(
+                "\n", strip=True
+            )
+            yield number, name, date, uid, message
+
+
+class LxmlParser:
+    """
+    lxml の iterparse で article を一つずつ読み、読み終えた要素は捨てていく
+    """
+
+    name = "lxml"
+    # BeautifulSoup の get_text() はこれらの中身を拾わない
+    IGNORED_TAGS = frozenset(("script", "style", "template"))
+
+    @classmethod
+    def _strings(cls, element) -> Iterator[str]:
+        if isinstance(element.tag, str) and element.tag not in cls.IGNORED_TAGS:
+            if element.text:
+                yield element.text
+            for child in element:
+                yield from cls._strings(child)
+                if child.tail:
+                    yield child.tail
+
+    @classmethod
+    def _get_text(cls, element, separator: str = "") -> str:
+        """
+        BeautifulSoup の get_text(separator, strip=True) と同じ結果を返す
+        """
+        return separator.join(s for s in (t.strip() for t in cls._strings(element)) if s)
+
+    @staticmethod
+    def _find(element, tag: str, class_: str):
+        for e in element.iter(tag):
+            if class_ in (e.get("class") or "").split():
+                return e
+        return None
+
+    def iter_posts(self, markup: str | bytes) -> Iterator[RawPost]:
+        if not HAS_LXML:
+            raise RuntimeError("lxml がインストールされていません")
+        from lxml import etree
+
+        if isinstance(markup, str):
+            source, encoding = BytesIO(markup.encode("utf-8")), "utf-8"
+        else:
+            source, encoding = BytesIO(markup), None
+
+        for _, element in etree.iterparse(
+            source, events=("end",), tag="article", html=True, encoding=encoding
+        ):
+            number = name = date = uid = None
+            for meta in element.iter("details"):
+                if "post-header" not in (meta.get("class") or "").split():
+                    continue
+                number = self._get_text(self._find(meta, "span", "postid"))
+                name = self._get_text(self._find(meta, "span", "postusername"), " ")
+                date = self._get_text(self._find(meta, "span", "date"))
+                uid = self._get_text(self._find(meta, "span", "uid"))
+
+            message = self._get_text(self._find(element, "section", "post-content"), "\n")
+            yield number, name, date, uid, message
+
+            # 読み終えたレスを木から外し、メモリを使い続けないようにする
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+PARSERS = {parser.name: parser for parser in (BeautifulSoupParser, LxmlParser)}
+DEFAULT_PARSER = "lxml" if HAS_LXML else "bs4"
+
+
+def get_parser(name: str | None = None):
+    """
+    名前からパーサーのインスタンスを返す (既定は使える中で速いもの)
+    """
+    return PARSERS[name or DEFAULT_PARSER]()
@@ -0,0 +1,26 @@
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+def bounded_map(
+    executor: Executor, func: Callable[..., T], iterable: Iterable[tuple], window: int
+) -> Iterator[T]:
+    """
+    Executor.map() と違い、先読みを window 個までに抑えて、結果を元の順番で返す
+
+    iterable の各要素は func の引数のタプル
+    """
+    pending: Deque[Future] = deque()
+    try:
+        for args in iterable:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
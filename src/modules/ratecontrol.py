@@ -0,0 +1,195 @@
+"""
+ホストごとに、リクエストの間隔と同時に送る数を、応答に合わせて変える (AIMD)
+
+- 速い応答が続くと、同時に送る数を 1 ずつ増やし、間隔を少しずつ縮める
+- 遅い応答、429 / 503、接続の失敗があると、同時に送る数を半分にし、間隔を倍にする
+- 429 / 503 や失敗のあとは、Retry-After があればその秒数、
+  無ければ失敗が続くほど長く (指数的に、ジッター付きで) そのホストへのリクエストを止める
+
+min_interval と max_interval を同じにすると、これまでどおりの一定の間隔になる
+(それでも Retry-After と失敗のあとの待ち時間は守る)
+"""
+import random
+import threading
+from concurrent.futures import CancelledError
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic
+from typing import Dict
+from modules.metrics import METRICS
+
+# 混んでいるという意味の応答
+THROTTLE_STATUSES = (429, 503)
+
+# release() に渡す結果
+OK = "ok"
+THROTTLED = "throttled"
+FAILED = "failed"
+# サーバーの混み具合と関係のない結果 (dat 落ちなど)。間隔も同時に送る数も変えない
+NEUTRAL = "neutral"
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Retry-After (秒数か HTTP の日時) を、今から待つ秒数にする
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class HostState:
+    def __init__(self, interval: float, concurrency: int) -> None:
+        self.interval = interval
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.next_slot = 0.0
+        # この時刻まではリクエストしない (Retry-After や失敗のあとの待ち時間)
+        self.blocked_until = 0.0
+        # 続けて失敗した数と、続けて速く成功した数
+        self.failures = 0
+        self.streak = 0
+
+
+class AdaptiveRateController:
+    def __init__(
+        self,
+        interval: float = 0,
+        min_interval: float | None = None,
+        max_interval: float | None = None,
+        concurrency: int = 1,
+        max_concurrency: int | None = None,
+        slow: float = 5,
+        backoff: float = 1,
+        max_backoff: float = 300,
+        jitter: float = 0.1,
+    ) -> None:
+        """
+        interval と concurrency は、ホストごとの間隔 (秒) と同時に送る数の初期値
+
+        slow 秒より遅い応答は、成功していても混んでいるとみなす。
+        backoff は失敗のあとの待ち時間の基準で、失敗が続くたびに倍になる (最大 max_backoff 秒)
+        """
+        self.interval = interval
+        self.min_interval = interval if min_interval is None else min_interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self.concurrency = max(concurrency, 1)
+        self.max_concurrency = max(max_concurrency or self.concurrency, self.concurrency)
+        self.slow = slow
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.hosts: Dict[str, HostState] = {}
+        self.__condition = threading.Condition()
+        self.__cancelled = threading.Event()
+
+    def __state(self, host: str) -> HostState:
+        if (state := self.hosts.get(host)) is None:
+            state = self.hosts[host] = HostState(self.interval, self.concurrency)
+        return state
+
+    def backoff_delay(self, failures: int) -> float:
+        """
+        failures 回続けて失敗したあとに待つ秒数 (半分は固定で、残りの半分はランダム)
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def acquire(self, host: str) -> None:
+        """
+        host に同時に送っている数が上限を下回り、次の枠が来るまで待つ
+        """
+        with self.__condition:
+            state = self.__state(host)
+            while state.in_flight >= state.concurrency and not self.__cancelled.is_set():
+                self.__condition.wait()
+            if self.__cancelled.is_set():
+                raise CancelledError
+            now = monotonic()
+            slot = max(now, state.next_slot, state.blocked_until)
+            # 間隔は揃えすぎないよう、少しずらす
+            state.next_slot = slot + state.interval * (
+                1 + random.uniform(-self.jitter, self.jitter))
+            state.in_flight += 1
+        if slot > now:
+            with METRICS.time("sleep"):
+                cancelled = self.__cancelled.wait(slot - now)
+            if cancelled:
+                with self.__condition:
+                    state.in_flight -= 1
+                raise CancelledError
+
+    def cancel(self) -> None:
+        """
+        待っている acquire() とそれ以降の acquire() を、CancelledError ですぐに終わらせる (中断したとき)
+        """
+        with self.__condition:
+            self.__cancelled.set()
+            self.__condition.notify_all()
+
+    def release(self, host: str, latency: float, outcome: str = OK,
+                retry_after: float | None = None) -> None:
+        """
+        acquire() したリクエストの結果 (OK / THROTTLED / FAILED / NEUTRAL) と所要時間 (秒) を伝える
+        """
+        with self.__condition:
+            state = self.__state(host)
+            state.in_flight -= 1
+            if outcome == NEUTRAL:
+                pass
+            elif outcome == OK:
+                state.failures = 0
+                if latency > self.slow:
+                    self.__decrease(state, "slow")
+                else:
+                    state.streak += 1
+                    # 今の同時に送る数と同じだけ続けて速ければ、一段階上げる
+                    if state.streak >= state.concurrency:
+                        self.__increase(state)
+            else:
+                state.failures += 1
+                METRICS.add("rate_throttled" if outcome == THROTTLED else "rate_failed")
+                self.__decrease(state, outcome)
+                delay = self.backoff_delay(state.failures) if retry_after is None \
+                    else min(retry_after, self.max_backoff)
+                state.blocked_until = max(state.blocked_until, monotonic() + delay)
+                METRICS.observe("backoff", delay)
+            METRICS.gauge("rate_interval_seconds", state.interval, host)
+            METRICS.gauge("rate_concurrency", state.concurrency, host)
+            self.__condition.notify_all()
+
+    def __increase(self, state: HostState) -> None:
+        state.streak = 0
+        concurrency = min(state.concurrency + 1, self.max_concurrency)
+        interval = max(state.interval * 0.9, self.min_interval)
+        if (concurrency, interval) != (state.concurrency, state.interval):
+            state.concurrency, state.interval = concurrency, interval
+            METRICS.add("rate_increase")
+
+    def __decrease(self, state: HostState, reason: str) -> None:
+        """
+        reason は slow / throttled / failed
+        """
+        state.streak = 0
+        concurrency = max(state.concurrency // 2, 1)
+        interval = min(max(state.interval * 2 or 1, self.min_interval), self.max_interval)
+        if (concurrency, interval) != (state.concurrency, state.interval):
+            state.concurrency, state.interval = concurrency, interval
+            METRICS.add(f"rate_decrease_{reason}")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        ホストごとの今の間隔 (秒) と同時に送る数
+        """
+        with self.__condition:
+            return {
+                host: {"interval": state.interval, "concurrency": state.concurrency}
+                for host, state in sorted(self.hosts.items())
+            }
@@ -0,0 +1,76 @@
+"""
+スレッドのページの本文を、少しずつ受け取りながら文字列にする
+
+requests の response.text は、本文を bytes で全て持ってから文字コードを推測して decode する。
+ここでは chunk ごとに CP932 (Shift_JIS) の増分デコーダーに通し、
+"Gone." を見つけたらそこで読むのをやめ、meta タグの charset も chunk ごとに書き換える。
+手元に残るのは chunk ごとの文字列と、最後に繋げた一つの文字列だけになる
+"""
+import codecs
+from typing import Iterable, Iterator, List
+from modules.errors import BadContentError
+from modules.metrics import METRICS
+
+CHUNK_SIZE = 64 * 1024
+# dat 落ちしたスレッドの本文
+GONE = "Gone.\n"
+# 変換するときに UTF-8 として読ませるよう、meta タグを書き換える
+META_CHARSET = ("charset=Shift_JIS", 'charset="UTF-8"')
+# Shift_JIS と名乗っていても、実際には Windows の拡張文字 (①など) を含む
+CP932_ALIASES = frozenset(("shift_jis", "shift-jis", "sjis", "x-sjis", "windows-31j", "cp932"))
+DEFAULT_ENCODING = "cp932"
+
+
+def response_encoding(content_type: str | None) -> str:
+    """
+    Content-Type の charset から使う codec を決める (無ければ CP932)
+    """
+    for param in (content_type or "").split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "charset" and value:
+            charset = value.strip('"').lower()
+            if charset in CP932_ALIASES:
+                return DEFAULT_ENCODING
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                break
+    return DEFAULT_ENCODING
+
+
+def counted(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    受け取ったバイト数を METRICS の http_bytes に足しながら返す
+    """
+    for chunk in chunks:
+        METRICS.add("http_bytes", len(chunk))
+        yield chunk
+
+
+def decode_thread(chunks: Iterable[bytes], encoding: str = DEFAULT_ENCODING) -> str:
+    """
+    chunk ごとに decode し、meta タグの charset を書き換えた本文を返す
+
+    GONE を見つけた時点で BadContentError を送出する (残りは読まない)
+    """
+    old, new = META_CHARSET
+    # chunk の境目をまたぐ GONE や META_CHARSET を見落とさないよう、末尾は次に持ち越す
+    keep = max(len(GONE), len(old)) - 1
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    parts: List[str] = []
+    carry = ""
+
+    def check(text: str) -> str:
+        if GONE in text:
+            raise BadContentError("found 'Gone.' in the response")
+        return text.replace(old, new)
+
+    for chunk in chunks:
+        text = check(carry + decoder.decode(chunk))
+        if len(text) <= keep:
+            carry = text
+            continue
+        parts.append(text[:-keep])
+        carry = text[-keep:]
+    parts.append(check(carry + decoder.decode(b"", final=True)))
+    return "".join(parts)
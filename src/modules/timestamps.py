@@ -0,0 +1,67 @@
+"""
+5ch の日時の文字列を、タイムゾーン付きの ISO 8601 の文字列にする
+
+strptime() と astimezone() は一件ごとに重いので、
+数字は正規表現で取り出して datetime を直接作り、時間単位で結果を使い回す。
+
+これまでと同じく、日時はこのマシンのローカルタイムとして解釈してから日本時間に直す
+(ローカルタイムが日本時間なら、そのまま +09:00 が付く)
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+JST = timezone(timedelta(hours=9))
+
+_DIGITS = re.compile(r"\d+")
+# find.5ch.net の「2023年06月19日 12:34」
+_INDEX_DATE = re.compile(r"(\d{4})年(\d{1,2})月(\d{1,2})日 (\d{1,2}):(\d{1,2})")
+
+
+@lru_cache(maxsize=4096)
+def _hour(year: int, month: int, day: int, hour: int) -> datetime:
+    """
+    ローカルタイムの year/month/day hour:00 を日本時間にしたもの
+
+    ローカルタイムとの時差は (夏時間の切り替わりも含め) 時間単位でしか変わらないとみなす
+    """
+    return datetime(year, month, day, hour).astimezone(JST)
+
+
+def post_date(date: str) -> str:
+    """
+    レスの日時 (e.g. "2023/06/19(月) 12:34:56.78") を変換する
+
+    あぼーん ("NG") は空文字列にする
+    """
+    if date == "NG":
+        return ""
+    parts = _DIGITS.findall(date)
+    assert len(parts) == 7
+    year, month, day, hour, minute, second, fraction = parts
+    if len(fraction) > 6:
+        raise ValueError(f"unconverted data remains: {fraction[6:]}")
+    # strptime() の %f と同じく、右を 0 で埋めてマイクロ秒にする
+    return (
+        _hour(int(year), int(month), int(day), int(hour))
+        + timedelta(minutes=int(minute), seconds=int(second),
+                    microseconds=int(fraction.ljust(6, "0")))
+    ).isoformat()
+
+
+def index_date(date: str) -> str:
+    """
+    スレッド検索の更新日時 (e.g. "2023年06月19日 12:34") を変換する
+    """
+    if (m := _INDEX_DATE.fullmatch(date)) is None:
+        # 形式が違うときは、これまでどおり strptime() に任せる (ValueError になる)
+        return datetime.strptime(date, "%Y年%m月%d日 %H:%M").astimezone(JST).isoformat()
+    year, month, day, hour, minute = map(int, m.groups())
+    return (_hour(year, month, day, hour) + timedelta(minutes=minute)).isoformat()
+
+
+def bbskey_date(bbskey: int | str) -> str:
+    """
+    スレッドが立った日時 (bbskey はその UNIX 時間)
+    """
+    return datetime.fromtimestamp(int(bbskey), JST).isoformat()
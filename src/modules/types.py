@@ -1,4 +1,4 @@
-from typing import Dict, List, TypeAlias
+from typing import Dict, List, NamedTuple, TypeAlias
 import requests
 
 Response: TypeAlias = requests.models.Response
@@ -7,3 +7,15 @@ Threads: TypeAlias = Dict[str, Thread]
 ThreadsChunk: TypeAlias = List[Dict[str, str]]
 Post: TypeAlias = Dict[str, int | str]
 Posts: TypeAlias = Dict[int, Post]
+
+
+class PostRecord(NamedTuple):
+    """
+    `messages` の一行 (列の順番どおりなので、そのまま executemany に渡せる)
+    """
+    bbskey: int
+    number: int
+    name: str
+    date: str
+    uid: str
+    message: str
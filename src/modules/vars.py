@@ -1,19 +1,35 @@
+"""
+データベースの保存先 (環境変数 JNVADB_PATH)
+
+import しただけでは .env を読まない。jnvadb_path() を初めて呼んだときに読む
+"""
 import logging
 import os
 import sys
-import dotenv
+from functools import cache
+
+
+@cache
+def _load_dotenv() -> None:
+    import dotenv
+
+    dotenv.load_dotenv()
+
+
+def jnvadb_path() -> str | None:
+    """
+    JNVADB_PATH を返す (設定されていなければ None)
 
-dotenv.load_dotenv()
-JNVADB_PATH = os.environ.get('JNVADB_PATH')
+    設定されているのにファイルが無いときは、database_helper.py を先に動かすよう伝えて終了する
+    """
+    _load_dotenv()
+    path = os.environ.get('JNVADB_PATH')
 
-if JNVADB_PATH is not None:
-    try:
-        if not os.path.exists(JNVADB_PATH):
-            raise FileNotFoundError
-    except FileNotFoundError:
-        logging.exception(
+    if path is not None and not os.path.exists(path):
+        logging.error(
             "Sqlite3 database not found. "
             "Please run 'database_helper.py' "
             "before the execution of this program"
         )
         sys.exit(1)
+    return path
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+アーカイブしたレスを全文検索する
+"""
+import sqlite3
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from contextlib import closing
+from typing import List, Tuple
+
+from modules.connection import connect
+from modules.vars import jnvadb_path
+
+# trigram の索引は 3 文字以上の語句でしか引けない
+MIN_QUERY_LENGTH = 3
+
+
+def search(conn: sqlite3.Connection, query: str, limit: int = 20) -> List[Tuple[int, int, str]]:
+    """
+    関連度の高い順に (bbskey, number, 本文の抜粋) を返す
+
+    3 文字未満の語句は索引で引けないので、LIKE で探して新しい順に返す
+    """
+    if len(query) < MIN_QUERY_LENGTH:
+        return conn.execute(
+            """
+            SELECT bbskey, number, substr(message, 1, 64) FROM messages
+            WHERE message LIKE '%' || ? || '%'
+            ORDER BY bbskey DESC, number DESC LIMIT ?
+            """, (query, limit)).fetchall()
+
+    # 語句をそのまま一つのフレーズとして扱う
+    phrase = '"' + query.replace('"', '""') + '"'
+    return conn.execute(
+        """
+        SELECT bbskey, number, snippet(messages_fts, 0, '[', ']', '…', 16)
+        FROM messages_fts WHERE messages_fts MATCH ?
+        ORDER BY rank LIMIT ?
+        """, (phrase, limit)).fetchall()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="アーカイブしたレスを全文検索する", formatter_class=RawTextHelpFormatter
+    )
+    parser.add_argument("query", help="検索する語句", metavar="query")
+    parser.add_argument(
+        "-n",
+        "--limit",
+        default=20,
+        help="表示する件数 (既定: %(default)s件)",
+        metavar="num",
+        required=False,
+        type=int,
+    )
+    args = parser.parse_args()
+
+    if (path := jnvadb_path()) is None:
+        sys.exit(1)
+
+    # クロール中でも読めるよう、WAL のデータベースを読み出し専用で開く
+    with closing(connect(path, readonly=True)) as conn:
+        for bbskey, number, snippet in search(conn, args.query, args.limit):
+            print(f"{bbskey}\t{number}\t{snippet}".replace("\n", " "))